@@ -24,9 +24,15 @@ class NeMoMegaMolBARTWrapper():
 
     def __init__(self,
                  model_cfg=None,
-                 random_weights=False) -> None:
+                 random_weights=False,
+                 device=None) -> None:
         super().__init__()
 
+        # follow the available hardware unless a device is given
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+
         if model_cfg is None:
             log.info('Loading default configuration...')
             model_cfg = OmegaConf.load(
@@ -65,7 +71,8 @@ class NeMoMegaMolBARTWrapper():
         encoder_mask = [([1] * len(seq)) + ([0] * (pad_length - len(seq))) for seq in token_ids]
         token_ids = [seq + ([self.tokenizer.pad_id] * (pad_length - len(seq))) for seq in token_ids]
 
-        token_ids = torch.tensor(token_ids, dtype=torch.int64).cuda()
+        token_ids = torch.tensor(token_ids, dtype=torch.int64,
+                                 device=self.device)
         encoder_mask = torch.tensor(encoder_mask,
                                     dtype=torch.int64,
                                     device=token_ids.device)
@@ -105,7 +112,7 @@ class NeMoMegaMolBARTWrapper():
         trainer = Trainer(
             plugins=NLPDDPPlugin(),
             devices=1,
-            accelerator='gpu',
+            accelerator='gpu' if self.device.type == 'cuda' else 'cpu',
             precision=32, #TODO: Run benchmark to verify this value has no or
             #                     minimum impact on KPIs.
         )
@@ -116,6 +123,7 @@ class NeMoMegaMolBARTWrapper():
                 restore_path=model_cfg.model.model_path,
                 trainer=trainer,
                 save_restore_connector=NLPSaveRestoreConnector(),
+                map_location=self.device,
             )
         else:
             # Initialize with random weights
@@ -126,7 +134,7 @@ class NeMoMegaMolBARTWrapper():
             cfg.model.num_attention_heads=8
             cfg.model.precision = cfg.trainer.precision
 
-            model = MegaMolBARTModel(cfg.model, trainer)
+            model = MegaMolBARTModel(cfg.model, trainer).to(self.device)
 
         model.freeze()
 
@@ -348,18 +348,33 @@ class CoreAttention(MegatronModule):
         # on average it should not be partition dependent.
         self.attention_dropout = torch.nn.Dropout(attention_dropout)
 
+        # CLM explainability, what to keep of attention_probs:
+        #   'full':    attention + gradient of every head
+        #   'reduced': only clamp(attn * grad, min=0).mean(heads)
+        #   None:      nothing
+        self.attn_capture = 'full'
+
     def save_attn(self, attn):
         self.attn = attn
 
     def save_attn_gradients(self, attn_gradients):
         self.attn_gradients = attn_gradients
 
+    def save_attn_relevance(self, attn_gradients):
+        # reduce to [b, sq, sk] in float32, drop the raw tensors
+        attn, self.attn = self.attn, None
+        self.attn_relevance = (
+            attn_gradients.float() * attn.float()).clamp(min=0).mean(dim=1)
+
     def get_attn(self):
         return self.attn
 
     def get_attn_gradients(self):
         return self.attn_gradients
 
+    def get_attn_relevance(self):
+        return self.attn_relevance
+
     def forward(
         self,
         query_layer,
@@ -403,7 +418,7 @@ class CoreAttention(MegatronModule):
             output_size[2],
             output_size[3],
             dtype=query_layer.dtype,
-            device=torch.cuda.current_device(),
+            device=query_layer.device,
         )
 
         # Raw attention scores. [b * np, sq, sk]
@@ -452,14 +467,17 @@ class CoreAttention(MegatronModule):
         # CLM EXPLAINABILTIY: SAVE ATTENTION + GRAD
         # ===========================
         # if not self.training:
-        if attention_probs.requires_grad:
+        if attention_probs.requires_grad and self.attn_capture == 'full':
             self.save_attn(attention_probs)
             attention_probs.register_hook(self.save_attn_gradients)
+        elif attention_probs.requires_grad and self.attn_capture == 'reduced':
+            self.save_attn(attention_probs.detach())
+            attention_probs.register_hook(self.save_attn_relevance)
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
 
-        if not self.sequence_parallel:
+        if not self.sequence_parallel and attention_probs.is_cuda:
             with tensor_parallel.random.get_cuda_rng_tracker().fork():
                 attention_probs = self.attention_dropout(attention_probs)
         else:
@@ -680,14 +698,14 @@ class ParallelAttention(MegatronModule):
 
         return hidden_states
 
-    def _allocate_memory(self, inference_max_sequence_len, batch_size, dtype):
+    def _allocate_memory(self, inference_max_sequence_len, batch_size, dtype, device=None):
         return torch.empty(
             inference_max_sequence_len,
             batch_size,
             self.num_attention_heads_per_partition,
             self.hidden_size_per_attention_head,
             dtype=dtype,
-            device=torch.cuda.current_device(),
+            device=device if device is not None else torch.cuda.current_device(),
         )
 
     def _transpose_last_dim(self, mixed_layer, num_splits, num_splits_first):
@@ -744,10 +762,10 @@ class ParallelAttention(MegatronModule):
         if set_inference_key_value_memory:
             assert inference_max_sequence_len and inference_max_sequence_len > 0
             self.inference_key_memory = self._allocate_memory(
-                inference_max_sequence_len, hidden_states.size(1), hidden_states.dtype
+                inference_max_sequence_len, hidden_states.size(1), hidden_states.dtype, hidden_states.device
             )
             self.inference_value_memory = self._allocate_memory(
-                inference_max_sequence_len, hidden_states.size(1), hidden_states.dtype
+                inference_max_sequence_len, hidden_states.size(1), hidden_states.dtype, hidden_states.device
             )
             self.inference_current_sequence_len = 0
 
@@ -1500,7 +1518,7 @@ class ParallelTransformerLayer(ParallelTransformerLayer_):
                 self_attention_relative_position_bias,
                 cross_attention_relative_position_bias,
             )
-        with torch.autocast(device_type="cuda", dtype=self.dtype):
+        with torch.autocast(device_type=hidden_states.device.type, dtype=self.dtype):
             return super().forward(
                 hidden_states,
                 attention_mask,
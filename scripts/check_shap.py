@@ -0,0 +1,65 @@
+import numpy as np
+import torch
+from src.explainer import TokenPartitionShap, ExactTokenShap
+
+
+class ToyTokenizer():
+    ''' one token per character, 0: padding, 1: <MASK> '''
+    pad_id, mask_id = 0, 1
+
+    def text_to_tokens(self, smi):
+        return list(smi)
+
+    def token_to_ids(self, tokens):
+        return [2 + ord(t) % 64 for t in tokens]
+
+
+class ToyModel():
+    ''' masked_forward of explain_shap on a value per token id:
+        additive sum, or its square (token interactions) '''
+    encoder_device = torch.device('cpu')
+
+    def __init__(self, squared=False, seed=0):
+        rng = np.random.default_rng(seed)
+        self.values = torch.tensor(rng.normal(size=66))
+        self.squared = squared
+
+    def masked_forward(self, ids, masks, lengths):
+        out = (self.values[ids] * masks).sum(dim=1)
+        return out ** 2 if self.squared else out
+
+
+def chain_clustering(smi):
+    ''' linkage [M-1, 4] merging tokens left to right '''
+    M = len(smi)
+    return [[0 if j == 0 else M + j - 1, j + 1, 1., j + 2]
+            for j in range(M - 1)]
+
+
+def check_shap(smiles=('CCO', 'CC(=O)N', 'c1ccccc1O')):
+    ''' exact token shapley values sum to f(all) - f(none), and agree
+        with TokenPartitionShap (owen values) on an additive model '''
+    tokenizer = ToyTokenizer()
+    for squared in [False, True]:
+        model = ToyModel(squared=squared)
+        exact = ExactTokenShap(model, tokenizer)(list(smiles))
+        for smi, phi in zip(smiles, exact):
+            ids = torch.tensor([tokenizer.token_to_ids(list(smi))])
+            f_all = model.masked_forward(ids, torch.ones_like(ids), None)
+            f_none = model.masked_forward(ids, torch.zeros_like(ids), None)
+            assert np.isclose(phi.sum(), float(f_all - f_none)), smi
+        print(f"efficiency ok (squared={squared})")
+
+    model = ToyModel()
+    exact = ExactTokenShap(model, tokenizer)(list(smiles))
+    partition = TokenPartitionShap(model, tokenizer, chain_clustering,
+                                   max_evals=100000)(list(smiles))
+    for smi, phi_exact, phi_part in zip(smiles, exact, partition):
+        ids = tokenizer.token_to_ids(list(smi))
+        assert np.allclose(phi_exact, model.values[ids].numpy()), smi
+        assert np.allclose(phi_exact, phi_part), smi
+    print('exact and partition shap agree on the additive model')
+
+
+if __name__ == "__main__":
+    check_shap()
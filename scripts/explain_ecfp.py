@@ -10,19 +10,46 @@ import pytorch_lightning as pl
 import seaborn as sns
 from matplotlib.colors import Normalize
 import torch
-from src.dataloader import ECFPDataSplit
+from src.dataloader import ECFPDataSplit, ecfp_kwargs, load_split
 from src.model import ECFPLinear
 from src.explainer import ColorMapper
+from src.render import MoleculeRenderer
+from src.store import save_attributions
+from src.cache import AttributionCache, hash_file
 import hydra
 import pickle
 from omegaconf import OmegaConf, DictConfig
 import pandas as pd
 import shap
 import json
-from scipy.sparse import csr_matrix
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 # from sklearn.ensemble import RandomForestRegressor
 # from sklearn.svm import SVR
 
+# batch function of the running map_row_chunks, inherited by forked workers
+_chunk_fn = None
+
+
+def _run_chunk(X):
+    return np.asarray(_chunk_fn(X))
+
+
+def map_row_chunks(fn, X, n_workers=0, chunksize=64):
+    ''' fn over row chunks of X (array or csr), stacked to [n, ...].
+        chunks run in forked worker processes, so fn (eg. a TreeExplainer
+        with its background data) is inherited instead of pickled '''
+    global _chunk_fn
+    _chunk_fn = fn
+    chunks = [X[i:i + chunksize] for i in range(0, X.shape[0], chunksize)]
+    if n_workers and len(chunks) > 1:
+        ctx = mp.get_context('fork')
+        with ProcessPoolExecutor(n_workers, mp_context=ctx) as pool:
+            done = list(pool.map(_run_chunk, chunks))
+    else:
+        done = [_run_chunk(chunk) for chunk in chunks]
+    return np.concatenate(done) if done else np.zeros((0,))
+
 
 @hydra.main(
     version_base="1.3", config_path="../conf", config_name="config")
@@ -34,9 +61,8 @@ def explain_ecfp(cfg: DictConfig) -> None:
     pl.seed_everything(cfg.model.seed)
     root = f"./data/{cfg.task.task}/{cfg.split.split}"
 
-    with open(f"{root}/test.pkl", 'rb') as f:
-        test = pickle.load(f)
-    test_dataset = ECFPDataSplit(test, nbits=cfg.model.nbits)
+    test = load_split(root, 'test')
+    test_dataset = ECFPDataSplit(test, **ecfp_kwargs(cfg))
     # test_loader = DataLoader(test, batch_size=cfg.model.n_batch,
     #                          shuffle=False, num_workers=8)
 
@@ -69,9 +95,8 @@ def explain_ecfp(cfg: DictConfig) -> None:
                 metrics = json.load(f)
             best_fold = np.argmin([v['val_mae'] for k, v in metrics.items()
                                    if k not in ['valid', 'test', 'best_fold']])
-            with open(f"{root}/train{best_fold}.pkl", 'rb') as f:
-                train = pickle.load(f)
-            train_dataset = ECFPDataSplit(train, nbits=cfg.model.nbits)
+            train = load_split(root, 'train', best_fold)
+            train_dataset = ECFPDataSplit(train, **ecfp_kwargs(cfg))
     else:
         raise NotImplementedError
 
@@ -113,24 +138,6 @@ def explain_ecfp(cfg: DictConfig) -> None:
         elif cfg.head.head in ['svr', 'rf']:
             return [f"{weight_vector[int(b)]:.3f}\t#{b}" for b in bits]
 
-    def calc_shap_weights(explainer, X):
-        X = np.array(X)
-        if X.shape[0] == cfg.model.nbits:
-            X = X[None, ...]
-
-        shap_values = explainer.shap_values(X)[0]
-        print('len shap val vec', len(shap_values))
-        return shap_values
-        # return shap_values
-        # print([int(b) for b in bits])
-        # print('vals', shap_values)
-        # print('len', len(shap_values))
-        # print([f"{shap_values[int(b)][0]:.3f}\t#{b}" for b in bits][:7])
-        # print("*"*22)
-        # [print(f"{shap_values[int(b)]}") for b in bits]
-        # return [f"{shap_values[int(b)]}" for b in bits]
-        # return [f"{shap_values[int(b)][0]:.3f}\t#{b}" for b in bits]
-
     def make_morgan_dict(smi, nbits=cfg.model.nbits):
         mol = Chem.MolFromSmiles(smi)
         bi = {}
@@ -149,49 +156,6 @@ def explain_ecfp(cfg: DictConfig) -> None:
         p.save(f"{basepath}/{mdir}/viz/{uid}_morgan_bits.png")
         return p
 
-    def attribute_morgan(smi, bits_dict, weights_vec, norm=True):
-        ''' attribute morgan weights to molecule:
-            for each on-bit (x), attribute w_x (regression head weight for x)
-            to each atom involved in this on-bit '''
-        mol = Chem.MolFromSmiles(smi)
-        # for atom in mol.GetAtoms():
-        #     print("Atom index:", atom.GetIdx(), ", Atomic symbol:", atom.GetSymbol())
-
-        atom_weights = np.zeros(len(mol.GetAtoms()))
-        # atom_positive = np.zeros(len(mol.GetAtoms()))
-        # atom_negative = np.zeros(len(mol.GetAtoms()))
-        for _mol, x, bi in bits_dict.values():
-            assert Chem.MolToSmiles(mol) == Chem.MolToSmiles(_mol)
-            w_x = weights_vec[int(x)]
-            for _bid, tuples in bi.items():
-                atomsToUse = set()
-                for (atomId, radius) in tuples:
-                    # bi.value tuples are (atom_id_CENTER, radius)
-                    atomsToUse.update(extend_morgan(mol, atomId, radius))
-                    # print(_bit, "\t", atomId, "\t", atomsToUse)
-
-                if norm:
-                    w_x = w_x / len(atomsToUse)
-                atom_weights[list(atomsToUse)] += w_x
-
-                # if w_x > 0:
-                #     atom_positive[list(atomsToUse)] += w_x
-                # elif w_x < 0:
-                #     atom_negative[list(atomsToUse)] += w_x
-
-        return atom_weights  # , atom_positive, atom_negative
-
-    def extend_morgan(mol, atomId, radius=2):
-        ''' get atoms in radius centered on atomId. code from rdkit. '''
-        bitPath = Chem.FindAtomEnvironmentOfRadiusN(mol, radius, atomId)
-
-        # get the atoms for highlighting
-        atomsToUse = set((atomId, ))
-        for b in bitPath:
-            atomsToUse.add(mol.GetBondWithIdx(b).GetBeginAtomIdx())
-            atomsToUse.add(mol.GetBondWithIdx(b).GetEndAtomIdx())
-        return atomsToUse
-
     def to_rdkit_cmap(atom_weight, cmap=None):
         '''helper to map to shape required by RDkit to visualize '''
         if not cmap:
@@ -200,30 +164,17 @@ def explain_ecfp(cfg: DictConfig) -> None:
         atom_weight = norm(atom_weight)
         return {i: [tuple(cmap(w))] for i, w in enumerate(atom_weight)}
 
-    def plot_weighted_mol(atom_colors, smiles, logS, pred, uid="", suffix=""):
-        atom_colors = atom_colors
-        bond_colors = {}
-        h_rads = {}
-        h_lw_mult = {}
+    # png drawing runs in worker processes, RDKit crashes stay isolated
+    # pngs only with xai.render, else on demand by scripts/render_viz.py
+    render = cfg.xai.get('render', False)
+    renderer = MoleculeRenderer(cfg.xai.get('render_workers', 4),
+                                partial=True, cache_dir='./out/renders')
 
+    def plot_weighted_mol(atom_colors, smiles, logS, pred, uid="", suffix=""):
         # label = f'Exp logS: {logS:.2f}, predicted: {pred:.2f}\n{smiles}'
-        label = ''
-
-        mol = Chem.MolFromSmiles(smiles)
-        mol = Draw.PrepareMolForDrawing(mol)
-        d = Draw.rdMolDraw2D.MolDraw2DCairo(700, 700)
-        d.drawOptions().padding = 0.0
-
-        d.DrawMoleculeWithHighlights(
-            mol, label, atom_colors, bond_colors, h_rads, h_lw_mult, -1
-        )
-        # todo legend
-        d.FinishDrawing()
-
         fname = f'{basepath}/{mdir}/viz/{uid}_MorganAttrib{suffix}.png'
-        with open(fname, mode='wb') as f:
-            f.write(d.GetDrawingText())
-        return d
+        if render:
+            renderer.submit(smiles, atom_colors, fname)
 
     # coolwarm = sns.color_palette("coolwarm", as_cmap=True)
     # cmapper = ColorMapper(vmin=-1, vmax=1, cmap=coolwarm)
@@ -237,7 +188,9 @@ def explain_ecfp(cfg: DictConfig) -> None:
     # plot entire test set:
     smiles = test_dataset.smiles
     labels = test_dataset.labels
-    ecfps = test_dataset.ecfp
+    # atoms x bits environments of every molecule, attributions below are
+    # sparse mat-vecs with the per-molecule bit weights
+    test_dataset.environments(cfg.model.get('ecfp_workers', 8))
     # vmin, vmax = 0., 0.
     morgan_preds, morgan_weights = [], []
     # morgan_positive, morgan_negative = [], []
@@ -255,49 +208,65 @@ def explain_ecfp(cfg: DictConfig) -> None:
         background_data = np.array(train_dataset.ecfp)
         explainer = shap.TreeExplainer(model,
                                        background_data)
-        # all_weights = calc_shap_weights(model, ecfps)
 
-    # elif cfg.head.head in ['sverad']:
-    #     all_weights = model.feature_weights(csr_matrix(ecfps))
+    # morgan attributions keyed by SMILES + checkpoint hash
+    cache = AttributionCache(
+        './out/attributions' if cfg.xai.get('cache', True) else None, mdir,
+        hash_file(ckpt_path) + f"-{cfg.model.nbits}-env",
+        max_entries=cfg.xai.get('cache_size', 100000))
+
+    # preds and per-molecule bit weights of all uncached molecules in a few
+    # chunked batch calls, the loop below only attributes and draws
+    todo = [uid for uid, smi in enumerate(smiles) if cache.peek(smi) is None]
+    row = {uid: i for i, uid in enumerate(todo)}
+    n_workers = cfg.xai.get('weight_workers', 8)
+    chunksize = cfg.xai.get('weight_chunk', 64)
+    print(f"batch weights for {len(todo)} molecules")
+    if todo and cfg.head.head in ['lin', 'hier']:
+        with torch.no_grad():
+            all_preds = model(test_dataset.dense(todo)).numpy()
+    elif todo and cfg.head.head in ['svr', 'rf']:
+        all_preds = model.predict(test_dataset.csr(todo))
+        if cfg.head.head == 'rf':
+            all_weights = map_row_chunks(
+                explainer.shap_values, test_dataset.bits(todo).astype(float),
+                n_workers, chunksize)
+        elif cfg.head.head == 'svr':
+            all_weights = map_row_chunks(
+                model.feature_weights, test_dataset.csr(todo),
+                n_workers, chunksize)
 
     print('explaining')
-    for uid, (smi, logs, ecfp) in enumerate(zip(smiles, labels, ecfps)):
-        if cfg.head.head in ['lin', 'hier']:
-            pred = model(ecfp[None, ...]).detach().numpy().item()
-        elif cfg.head.head in ['svr', 'rf']:
-            pred = model.predict(ecfp[None, ...])
-
-        # pred = model.predict(ecfp[None, ...]).detach().numpy().item()
-        # pred = model.predict(test_dataset[:64]).detach().numpy().item()
-
-        bits_dict = make_morgan_dict(smi, nbits=cfg.model.nbits)
-        # morgan_weight, morgan_pos, morgan_neg = attribute_morgan(
-        #     smi, bits_dict, weights)
-
-        if cfg.head.head in ['rf']:
-            # for svr, rf re-calculate weights using shap,
-            # for lin the weights vec stays permanent
-            weights = calc_shap_weights(explainer, ecfp)
-            [print(f"{weights[int(b)]}", '\t', b) for b in bits_dict]
-            # wgt = all_weights[uid]
-            # [print(f"{wgt[int(b)]}", '\t', b) for b in bits_dict]
-            # assert np.allclose(wgt, weights, 1e-2)
-
-            # weights = model.coef_[0]
-            # print(weights.shape)
-        elif cfg.head.head in ['svr']:
-            # weights = all_weights[uid]
-            weights = model.feature_weights(csr_matrix(ecfp[None, ...]))[0]
-            # print(weights.shape)
-            # print(weights)
-            # [print(f"{weights[int(b)]}", '\t', b) for b in bits_dict]
-        morgan_weight = attribute_morgan(smi, bits_dict, weights)
-
-        topk_bits_dict = sort_dict_by_weight(
-            bits_dict, weights, topk=cfg.xai.topk)
-        _ = draw_morgan_bits(topk_bits_dict, uid=uid)
-
-        morgan_preds.append(pred)
+    for uid, (smi, logs) in enumerate(zip(smiles, labels)):
+        on_bits = test_dataset.on_bits[uid]
+        entry = cache.get(smi)
+        if entry is not None:
+            pred, morgan_weight = entry['preds'], entry['atom_weights']
+            if cfg.head.head in ['svr', 'rf']:
+                # per-molecule weights, on-bits are all that is drawn
+                weights = np.zeros(cfg.model.nbits)
+                for b, w in entry['bit_weights'].items():
+                    weights[b] = w
+        else:
+            pred = all_preds[row[uid]]
+            if cfg.head.head in ['svr', 'rf']:
+                # for svr, rf per-molecule weights (svr feature weights,
+                # rf shap values), for lin the weights vec stays permanent
+                weights = all_weights[row[uid]]
+            morgan_weight = test_dataset.attribute(uid, weights)
+
+            bit_weights = {int(b): weights[int(b)] for b in on_bits} \
+                if cfg.head.head in ['svr', 'rf'] else None
+            cache.put(smi, preds=pred, atom_weights=morgan_weight,
+                      bit_weights=bit_weights)
+
+        if render:
+            bits_dict = make_morgan_dict(smi, nbits=cfg.model.nbits)
+            topk_bits_dict = sort_dict_by_weight(
+                bits_dict, weights, topk=cfg.xai.topk)
+            _ = draw_morgan_bits(topk_bits_dict, uid=uid)
+
+        morgan_preds.append(float(np.ravel(pred)[0]))
         morgan_weights.append(morgan_weight)
         # morgan_positive.append(morgan_pos)
         # morgan_negative.append(morgan_neg)
@@ -333,8 +302,13 @@ def explain_ecfp(cfg: DictConfig) -> None:
         'split': 'test'
     })
 
+    cache.save()
+    renderer.run()
     attributions = attributions.reset_index().rename(columns={'index': 'uid'})
-    attributions.to_csv(f"{basepath}/{mdir}/attributions.csv", index=False)
+    save_attributions(f"{basepath}/{mdir}", attributions,
+                      export_csv=cfg.xai.get('export_csv', False),
+                      viz="{uid}_MorganAttrib_div.png", cmap='div',
+                      normalize=True, partial=True)
 # print(vmin, vmax)
 
 # https://github.com/rdkit/rdkit/blob/d9d1fe2838053484027ba9f5f74629069c6984dc/rdkit/Chem/Draw/__init__.py#L947
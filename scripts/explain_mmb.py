@@ -14,8 +14,14 @@ from sklearn import linear_model
 
 from src.model import AqueousRegModel, BaselineAqueousModel
 from src.maskedhead import MaskedLinearRegressionHead
+from src.dataloader import DataSplit, LengthBucketSampler, token_lengths
+from src.dataloader import load_split
+from src.cache import AttributionCache
 from src.explainer import ColorMapper, MolecularSelfAttentionViz
-from src.explainer import make_legend, make_div_legend
+from src.explainer import make_legend, make_div_legend, cmap_from_name
+from src.render import MoleculeRenderer
+from src.store import save_attributions
+from src.device import trainer_kwargs
 import hydra
 from omegaconf import OmegaConf, DictConfig
 
@@ -30,9 +36,10 @@ def explain_mmb(cfg: DictConfig) -> None:
     print(OmegaConf.to_yaml(cfg))
 
     pl.seed_everything(cfg.model.seed)
+    # cpu threads are set before the model is loaded
+    device_args = trainer_kwargs(cfg)
     root = f"./data/{cfg.task.task}/{cfg.split.split}"
-    with open(f"{root}/test.pkl", 'rb') as f:
-        test = pickle.load(f)
+    test = load_split(root, 'test')
 
     # test.smiles = test.smiles[[2, 5, 12, 16]]
     # test.labels = test.labels[[2, 5, 12, 16]]
@@ -42,9 +49,6 @@ def explain_mmb(cfg: DictConfig) -> None:
     # test.smiles = test.smiles[:16]
     # test.labels = test.labels[:16]
 
-    test_loader = DataLoader(test, batch_size=cfg.model.n_batch,
-                             shuffle=False, num_workers=8)
-
     basepath = f"./out/{cfg.task.task}/{cfg.split.split}"
     mdir = f"{cfg.model.model}-{cfg.head.head}"
     ckpt_path = f"{basepath}/{mdir}/best.pt"
@@ -61,21 +65,15 @@ def explain_mmb(cfg: DictConfig) -> None:
                                 finetune=cfg.model.finetune)
         model.head.load_state_dict(torch.load(ckpt_path))
         model.explainer = MolecularSelfAttentionViz(
-            save_heatmap=cfg.xai.save_heat, sign='')
+            save_heatmap=cfg.xai.save_heat, sign='',
+            propagation=cfg.xai.get('propagation', 'row'))
 
     elif cfg.model.model in ['mmb-avg', 'mmb-ft-avg']:
         print('wrong xai config: mmb-avg+explain_mmb should be shap')
         raise NotImplementedError
 
     # colormap settings
-    if cfg.xai.cmap == 'div':
-        map = sns.color_palette("coolwarm", as_cmap=True)
-    elif cfg.xai.cmap == 'Reds':
-        map = sns.color_palette("Reds", as_cmap=True)
-    elif cfg.xai.cmap == 'red':
-        map = sns.light_palette("red", as_cmap=True)
-    else:
-        map = None  # default
+    map = cmap_from_name(cfg.xai.cmap)
     model.cmapper = ColorMapper(cmap=map)
 
     if cfg.xai.cmap == 'div':
@@ -93,33 +91,73 @@ def explain_mmb(cfg: DictConfig) -> None:
     model.eval()
 
     trainer = pl.Trainer(
-        accelerator='gpu',
-        gpus=1,
-        precision=16,
+        **device_args,
     )
 
-    # predict with trained model (ckpt_path)
-    all = trainer.predict(model, test_loader)
+    # heatmaps are written during predict_step, always recompute them
+    use_cache = cfg.xai.get('cache', True) and not cfg.xai.save_heat
+
+    def explain_test():
+        """ preds & attributions in test set order. cached by input
+            SMILES + model/explainer fingerprint, predict_step only runs
+            on cache misses. """
+        settings = (model.explainer.propagation, model.explainer.sign,
+                    model.cmapper.diverging)
+        cache = AttributionCache(
+            './out/attributions' if use_cache else None, mdir,
+            model.attribution_key(*settings),
+            max_entries=cfg.xai.get('cache_size', 100000))
+        missing = cache.missing(test.smiles)
+        if missing:
+            label = dict(zip(test.smiles, test.labels))
+            missing = DataSplit(missing, [label[s] for s in missing], 'test')
+            # batch SMILES of similar length to cut padding. heatmaps are
+            # named by the explainer's running uid: keep test set order
+            sampler = None
+            if cfg.model.get('bucket', False) and not cfg.xai.save_heat:
+                sampler = LengthBucketSampler(token_lengths(
+                    model.tokenizer, missing.smiles, model.token_prefix),
+                    batch_size=cfg.model.n_batch)
+                sampler.report('test')
+            # tokenize each batch once, shared by forward, explainer, cmapper
+            loader = DataLoader(missing, batch_size=cfg.model.n_batch,
+                                shuffle=False, num_workers=8,
+                                collate_fn=model.collator(), sampler=sampler)
+
+            # predict with trained model (ckpt_path)
+            all = trainer.predict(model, loader)
+            cache.update(
+                list(chain(*[f.get('smiles') for f in all])),
+                tokens=list(chain(*[f.get('tokens') for f in all])),
+                preds=torch.concat([f.get('preds') for f in all]
+                                   ).float().cpu().numpy(),
+                rel_weights=list(chain(*[f.get('rel_weights') for f in all])),
+                atom_weights=list(chain(*[f.get('atom_weights') for f in all])),
+            )
+        entries = cache.lookup(test.smiles)
+        cache.save()
+        return entries
 
-    smiles = [f.get('smiles') for f in all]
-    tokens = [f.get('tokens') for f in all]
-    preds = [f.get('preds') for f in all]
-    labels = [f.get('labels') for f in all]
-    # masks = [f.get('masks') for f in all]
+    entries = explain_test()
+    smiles = [e['smiles'] for e in entries]
+    tokens = [e['tokens'] for e in entries]
+    preds = np.array([e['preds'] for e in entries])
+    labels = np.array(test.labels, dtype=np.float32)
 
     if cfg.model.model in ['mmb', 'mmb-ft']:
-        rel_weights = [f.get('rel_weights') for f in all]
-        atom_weights = [f.get('atom_weights') for f in all]
-        rdkit_colors = [f.get('rdkit_colors') for f in all]
+        rel_weights = [e['rel_weights'] for e in entries]
+        atom_weights = [e['atom_weights'] for e in entries]
+        # colors follow the cmap setting, not cached
+        rdkit_colors = [model.cmapper.to_rdkit_cmap(w) for w in atom_weights]
 
     attributions = pd.DataFrame({
-        "smiles": list(chain(*smiles)),
-        "tokens": list(chain(*tokens)),
-        "rel_weights": list(chain(*rel_weights)),
-        "atom_weights": list(chain(*atom_weights)),
-        "rdkit_colors": list(chain(*rdkit_colors)),
-        "preds": torch.concat([f.get('preds') for f in all]).cpu().numpy(),
-        # "labels": torch.concat([f.get('labels') for f in all]).cpu().numpy(),
+        "smiles": smiles,
+        "tokens": tokens,
+        "rel_weights": rel_weights,
+        "atom_weights": atom_weights,
+        "rdkit_colors": rdkit_colors,
+        "preds": preds,
+        # "labels": labels,
         'split': 'test'
     })
 
@@ -137,41 +175,45 @@ def explain_mmb(cfg: DictConfig) -> None:
             #     model.head.fc1.weight.data[0] = -model.head.fc1.weight.data[0]
             #     print('post', torch.sum(torch.sign(model.head.fc1.weight[0])))
             model.explainer = MolecularSelfAttentionViz(
-                save_heatmap=cfg.xai.save_heat, sign=sign)
+                save_heatmap=cfg.xai.save_heat, sign=sign,
+                propagation=cfg.xai.get('propagation', 'row'))
 
             # change viz color to red/blue
             # color = 'blue' if sign == 'pos' else 'red'
             # model.cmapper = ColorMapper(color=color)
 
-            all_sgn = trainer.predict(model, test_loader)
-            sign_weights[sign] = [f.get('rel_weights') for f in all_sgn]
-            sign_colors[sign] = [f.get('rdkit_colors') for f in all_sgn]
-            sign_preds[sign] = [f.get('preds') for f in all_sgn]
+            sign_entries = explain_test()
+            sign_weights[sign] = [e['rel_weights'] for e in sign_entries]
+            sign_colors[sign] = [model.cmapper.to_rdkit_cmap(e['atom_weights'])
+                                 for e in sign_entries]
+            sign_preds[sign] = np.array([e['preds'] for e in sign_entries])
 
             # if sign in ['posneg', 'negpos']:
             #     sign_preds[sign] = -sign_preds[sign]
                 # sign_weights[sign] = -sign_weights[sign]
                 # sign_colors[sign] = -sign_colors[sign]
             # should _not_ be equal if applying sign_mask on fwd()
-            # sign_preds = [f.get('preds') for f in all_sgn]
-            # assert torch.allclose(torch.concat(preds), torch.concat(sign_preds),
-            #                       atol = 1e-2)
+            # assert np.allclose(preds, sign_preds[sign], atol = 1e-2)
 
-            attributions[f"{sign}_weights"] = list(chain(*sign_weights[sign]))
-            attributions[f"{sign}_colors"] = list(chain(*sign_colors[sign]))
-            attributions[f"{sign}_preds"] = list(chain(*sign_preds[sign]))
+            attributions[f"{sign}_weights"] = sign_weights[sign]
+            attributions[f"{sign}_colors"] = sign_colors[sign]
+            attributions[f"{sign}_preds"] = sign_preds[sign]
     # </pos>,</neg>
 
     attributions = attributions.reset_index().rename(columns={'index': 'uid'})
-    attributions.to_csv(f"{basepath}/{mdir}/attributions.csv", index=False)
+    # pngs are drawn on demand by scripts/render_viz.py from this store
+    save_attributions(f"{basepath}/{mdir}", attributions,
+                      export_csv=cfg.xai.get('export_csv', False),
+                      viz=f"{{uid}}_{xai}_MolViz.png", cmap=cfg.xai.cmap,
+                      partial=True)
 
 
     # calculate average quadrant contribution fraction towards prediction
-    agg_preds = np.array(list(chain(*preds)))
+    agg_preds = preds
     sanity_preds = np.zeros_like(agg_preds)
     # sanity_preds2 = np.zeros_like(agg_preds)
     for sign in sign_preds.keys():
-        sg_preds = np.array(list(chain(*sign_preds[sign])))
+        sg_preds = sign_preds[sign]
         sanity_preds += sg_preds
 
         # if sign in ['posneg', 'negpos']:
@@ -203,8 +245,8 @@ def explain_mmb(cfg: DictConfig) -> None:
     ###################################
 
     # load data and calculate errors
-    yhat = torch.concat(preds)
-    y = torch.concat(labels)
+    yhat = torch.tensor(preds, dtype=torch.float32)
+    y = torch.tensor(labels, dtype=torch.float32)
     # print(y)
     # print(yhat)
 
@@ -248,94 +290,57 @@ def explain_mmb(cfg: DictConfig) -> None:
 
     ###################
 
-    def plot_weighted_molecule(
-                atom_colors, smiles, token, label, pred, prefix=""
-            ):
-        atom_colors = atom_colors
-        bond_colors = {}
-        h_rads = {}  # ?
-        h_lw_mult = {}  # ?
-
-        # label = f'Exp {cfg.task.plot_propname}: {label:.2f}, predicted: {pred:.2f}\n{smiles}'
-        label = ''
-
-        mol = Chem.MolFromSmiles(smiles)
-        mol = Draw.PrepareMolForDrawing(mol)
-        d = Draw.rdMolDraw2D.MolDraw2DCairo(700, 700)
-        d.drawOptions().padding = 0.0
-
-        # some plotting issues for 'C@@H' and 'C@H' tokens since
-        # another H atom is rendered explicitly.
-        # Might break for ultra long SMILES using |c:1:| notation
-        vocab = model.cmapper.atoms + model.cmapper.nonatoms
-
-        mismatch = int(mol.GetNumAtoms()) - len(atom_colors.keys())
-        # if mismatch != 0:
-        if mismatch < 0:
-            print(f"Warning: {mismatch}: \
-                 {[t for t in token if t not in vocab]}, {prefix}")
-            # print(f"count mismatch for {smiles}:\
-                 # {[t for t in token if t not in vocab]}")
-            # print(f'{token}')
-            d.DrawMolecule(mol)
-
-        else:
-            d.DrawMoleculeWithHighlights(
-                mol, label, atom_colors, bond_colors, h_rads, h_lw_mult, -1
-            )
-        # todo legend
-        d.FinishDrawing()
+    if not cfg.xai.get('render', False):
+        return
 
-        with open(file=f"{basepath}/{mdir}/viz/{prefix}_MolViz.png",
-                  mode='wb') as f:
-            f.write(d.GetDrawingText())
+    # some plotting issues for 'C@@H' and 'C@H' tokens since
+    # another H atom is rendered explicitly.
+    # Might break for ultra long SMILES using |c:1:| notation
+    vocab = model.cmapper.atoms + model.cmapper.nonatoms
+    # png drawing runs in worker processes, RDKit crashes stay isolated
+    renderer = MoleculeRenderer(cfg.xai.get('render_workers', 4),
+                                partial=True, cache_dir='./out/renders')
 
     ###################
     # fid = model.head.fids
 
     # plot entire test set:
-    for b_nr, _ in enumerate(all):
-        for b_ix in range(len(smiles[b_nr])):
-            token = tokens[b_nr][b_ix]
-            # mask = masks[b_nr][b_ix]
-            smi = smiles[b_nr][b_ix]
-            lab = labels[b_nr][b_ix]
-            pred = preds[b_nr][b_ix]
-            uid = b_nr * cfg.model.n_batch + b_ix
-
-            if cfg.model.model in ['mmb', 'mmb-ft']:
-                atom_color = rdkit_colors[b_nr][b_ix]
-
-            # if uid not in [39, 94, 170, 210, 217, 451, 505, 695, 725, 755]:
-                # segmentation fault, likely due to weird structure?
-            if uid not in []:
-                plot_weighted_molecule(
-                    atom_color, smi, token, lab, pred, f"{uid}_{xai}"
-                )
-            for sign in sign_weights.keys():
-                s_color = sign_colors[sign][b_nr][b_ix]
-                s_pred = sign_preds[sign][b_nr][b_ix]
-                # plot_weighted_molecule(
-                #     s_color, smi, token, lab, s_pred, f"{uid}_{sign}_{xai}"
-                # )
-
-            # if sign_weights:
-                # pos_color = sign_colors['pos'][b_nr][b_ix]
-                # neg_color = sign_colors['neg'][b_nr][b_ix]
-                # pos_pred = sign_weights['pos_preds'][b_nr][b_ix]
-                # neg_pred = sign_weights['neg_preds'][b_nr][b_ix]
-                # assert pos_pred + neg_pred - pred <= 5e-2
-                # plot_weighted_molecule(
-                #     pos_color, smi, token, lab, pos_pred, f"{uid}_pos_{xai}"
-                # )
-                # plot_weighted_molecule(
-                #     neg_color, smi, token, lab, neg_pred, f"{uid}_neg_{xai}"
-                # )
-
-        if cfg.xai.save_heat and b_nr > 0:
+    for uid, (smi, token, lab, pred) in enumerate(
+            zip(smiles, tokens, labels, preds)):
+        # mask = masks[uid]
+        if cfg.model.model in ['mmb', 'mmb-ft']:
+            atom_color = rdkit_colors[uid]
+
+        mismatch = Chem.MolFromSmiles(smi).GetNumAtoms() - len(atom_color)
+        if mismatch < 0:
+            print(f"Warning: {mismatch}: \
+                 {[t for t in token if t not in vocab]}, {uid}_{xai}")
+        renderer.submit(
+            smi, atom_color, f"{basepath}/{mdir}/viz/{uid}_{xai}_MolViz.png"
+        )
+        for sign in sign_weights.keys():
+            s_color = sign_colors[sign][uid]
+            s_pred = sign_preds[sign][uid]
+            # renderer.submit(smi, s_color,
+            #     f"{basepath}/{mdir}/viz/{uid}_{sign}_{xai}_MolViz.png")
+
+        # if sign_weights:
+            # pos_color = sign_colors['pos'][uid]
+            # neg_color = sign_colors['neg'][uid]
+            # pos_pred = sign_preds['pos'][uid]
+            # neg_pred = sign_preds['neg'][uid]
+            # assert pos_pred + neg_pred - pred <= 5e-2
+            # renderer.submit(smi, pos_color,
+            #     f"{basepath}/{mdir}/viz/{uid}_pos_{xai}_MolViz.png")
+            # renderer.submit(smi, neg_color,
+            #     f"{basepath}/{mdir}/viz/{uid}_neg_{xai}_MolViz.png")
+
+        # first two batches only
+        if cfg.xai.save_heat and uid + 1 >= 2 * cfg.model.n_batch:
             break
-        # elif b_nr > 4:
+        # elif uid > 4 * cfg.model.n_batch:
         #     break
+    renderer.run()
 
 
 
@@ -11,7 +11,13 @@ import seaborn as sns
 import numpy as np
 
 from src.model import BaselineAqueousModel
-from src.explainer import ColorMapper, plot_weighted_molecule, make_div_legend
+from src.dataloader import load_split
+from src.device import default_device
+from src.cache import AttributionCache, LRUCache
+from src.explainer import ColorMapper, make_div_legend
+from src.explainer import TokenPartitionShap, ExactTokenShap
+from src.render import MoleculeRenderer
+from src.store import save_attributions
 from sklearn import linear_model
 from nemo_src.regex_tokenizer import RegExTokenizer
 import shap
@@ -41,7 +47,8 @@ class ShapTokenizer(RegExTokenizer):
         pad_length = 0
         encoder_mask = (
             [1] * len(token_id)) + ([0] * (pad_length - len(token_id)))
-        token_id = torch.tensor(token_id, dtype=torch.int64).cuda()
+        # ids are returned as lists, the model moves them to its device
+        token_id = torch.tensor(token_id, dtype=torch.int64)
         encoder_mask = torch.tensor(encoder_mask,
                                     dtype=torch.int64,
                                     device=token_id.device)
@@ -65,8 +72,7 @@ def explain_shap(cfg: DictConfig) -> None:
 
     pl.seed_everything(cfg.model.seed)
     root = f"./data/{cfg.task.task}/{cfg.split.split}"
-    with open(f"{root}/test.pkl", 'rb') as f:
-        test = pickle.load(f)
+    test = load_split(root, 'test')
     test_loader = DataLoader(test, batch_size=cfg.model.n_batch,
                              shuffle=False, num_workers=8)
 
@@ -76,7 +82,8 @@ def explain_shap(cfg: DictConfig) -> None:
 
     if cfg.model.model in ['mmb-avg', 'mmb-ft-avg']:
         model = BaselineAqueousModel(head=cfg.head.head,
-                                     finetune=cfg.model.finetune)
+                                     finetune=cfg.model.finetune,
+                                     device=default_device(cfg))
         model.head.load_state_dict(torch.load(ckpt_path))
     else:
         raise NotImplementedError
@@ -141,6 +148,19 @@ def explain_shap(cfg: DictConfig) -> None:
         model,
         masker
     )
+    # 'batched': owen values of all molecules in a batch at once on token
+    # ids, 'shap': shap.Explainer per molecule on masked strings
+    engine = cfg.xai.get('engine', 'batched')
+    # model outputs per masked token id sequence, shared by both engines
+    eval_cache = LRUCache(cfg.xai.get('eval_cache_size', 200000))
+    token_shap = TokenPartitionShap(model, tokenizer, masker.clustering,
+                                    n_forward=cfg.xai.get('n_forward', 1024),
+                                    cache=eval_cache)
+    # exact shapley values (2^n coalitions) for SMILES up to n tokens
+    exact_max_tokens = cfg.xai.get('exact_max_tokens', 10)
+    exact_shap = ExactTokenShap(model, tokenizer,
+                                n_forward=cfg.xai.get('n_forward', 1024),
+                                cache=eval_cache)
 
     attributions = pd.DataFrame(columns=[
         'smiles', 'tokens', 'preds', 'labels', 'atom_weights', 'split'
@@ -153,6 +173,17 @@ def explain_shap(cfg: DictConfig) -> None:
 
     make_div_legend()
     xai = cfg.model.model
+    # pngs only with xai.render, else on demand by scripts/render_viz.py
+    render = cfg.xai.get('render', False)
+    renderer = MoleculeRenderer(cfg.xai.get('render_workers', 4),
+                                cache_dir='./out/renders')
+
+    # shap values keyed by SMILES + model fingerprint
+    cache = AttributionCache(
+        './out/attributions' if cfg.xai.get('cache', True) else None, mdir,
+        model.attribution_key('shap', engine, exact_max_tokens,
+                              cmapper.diverging),
+        max_entries=cfg.xai.get('cache_size', 100000))
     # weights = model.head.fc1.weight[0].cpu().detach().numpy()
     # weights = weights[:, None]
     # bias = model.head.fc1.bias[0].cpu().detach().numpy()
@@ -164,9 +195,24 @@ def explain_shap(cfg: DictConfig) -> None:
         # shapvals = explainer(smiles).values
         shapvals = []
         tokens = [tokenizer.text_to_tokens(s) for s in smiles]
-        preds = model(smiles).cpu().detach().numpy()
+        cached = cache.lookup(smiles)
+        if any(e is None for e in cached):
+            preds = model(smiles).cpu().detach().numpy()
+        else:
+            preds = np.array([e['preds'] for e in cached])
         labels = labels.cpu().detach().numpy()
 
+        todo = [smi for b_ix, smi in enumerate(smiles) if cached[b_ix] is None]
+        short = [smi for smi in todo
+                 if len(tokenizer.text_to_tokens(smi)) <= exact_max_tokens]
+        long = [smi for smi in todo if smi not in short]
+        batch_shap = dict(zip(short, exact_shap(short))) if short else {}
+        if engine == 'batched' and long:
+            batch_shap.update(zip(long, token_shap(long)))
+        print(f"batch {b_nr}: {len(short)} exact, {len(long)} sampled, "
+              f"{exact_shap.n_evals + token_shap.n_evals} masked evaluations")
+        print(f"eval cache: {eval_cache}")
+
         # print('**', smiles, labels, tokens, preds, shapvals)
         # assert all([len(t) == len(s) for t, s in zip(tokens, shapvals)])
 
@@ -181,14 +227,20 @@ def explain_shap(cfg: DictConfig) -> None:
 
             # shapval = shapvals[b_ix]
 
-            if uid not in [108]:
-                shapval = explainer([smi]).values[0]
+            if cached[b_ix] is not None:
+                shapval = cached[b_ix]['shap_weights']
+                atom_weight = cached[b_ix]['atom_weights']
             else:
-                shapval = np.zeros(len(token))
+                if smi in batch_shap:
+                    shapval = batch_shap[smi]
+                else:
+                    shapval = explainer([smi]).values[0]
+                atom_weight = cmapper(shapval, token)
+                cache.put(smi, preds=pred, shap_weights=shapval,
+                          atom_weights=atom_weight)
             shapvals.append(shapval)
             print(uid, 'shapval:', shapval)
 
-            atom_weight = cmapper(shapval, token)
             atom_weights.append(atom_weight)
             atom_color = cmapper.to_rdkit_cmap(atom_weight)
             #
@@ -202,14 +254,14 @@ def explain_shap(cfg: DictConfig) -> None:
             # neg_color = cmapper(shap_neg, token)
             # neg_color = neg_cmapper.to_rdkit_cmap(neg_color)
 
-            if uid not in [108]:  # 17, 39, 94, 210, 217
-                # segmentation fault, likely due to weird structure?
-                plot_weighted_molecule(atom_color, smi, token, lab, pred,
-                                       f"{uid}_{xai}", f"{basepath}/{mdir}/viz/")
-                # plot_weighted_molecule(pos_color, smi, token, lab, pred,
-                #     f"{uid}_pos_{xai}", f"{basepath}/{mdir}/viz/")
-                # plot_weighted_molecule(neg_color, smi, token, lab, pred,
-                #     f"{uid}_neg_{xai}", f"{basepath}/{mdir}/viz/")
+            # rendered in worker processes, RDKit crashes stay isolated
+            if render:
+                renderer.submit(smi, atom_color,
+                                f"{basepath}/{mdir}/viz/{uid}_{xai}_MolViz.png")
+            # renderer.submit(smi, pos_color,
+            #     f"{basepath}/{mdir}/viz/{uid}_pos_{xai}_MolViz.png")
+            # renderer.submit(smi, neg_color,
+            #     f"{basepath}/{mdir}/viz/{uid}_neg_{xai}_MolViz.png")
 
         ###############################
 
@@ -231,9 +283,13 @@ def explain_shap(cfg: DictConfig) -> None:
         attributions.tokens, attributions.shap_weights
     )]))
 
+    cache.save()
+    renderer.run()
     attributions = attributions.reset_index(
         drop=True).rename(columns={'index': 'uid'})
-    attributions.to_csv(f"{basepath}/{mdir}/attributions.csv", index=False)
+    save_attributions(f"{basepath}/{mdir}", attributions,
+                      export_csv=cfg.xai.get('export_csv', False),
+                      viz=f"{{uid}}_{xai}_MolViz.png", cmap='div')
     # results = results.reset_index(drop=True)
     # results = results.reset_index().rename(columns={'index':'uid'})
     # results.to_csv('/workspace/results/shap/AqueousSolu_SHAP.csv', index=False)
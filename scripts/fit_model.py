@@ -1,12 +1,11 @@
 import torch
-from torch.utils.data import DataLoader
 import pytorch_lightning as pl
 # from pytorch_lightning.loggers import WandbLogger
 import wandb
 # from src.model import (
 #     ECFPModel
 # )
-from src.dataloader import ECFPDataSplit
+from src.dataloader import ECFPDataSplit, ecfp_kwargs, load_split
 import pickle
 import json
 import numpy as np
@@ -29,25 +28,20 @@ def fit(cfg: DictConfig) -> None:
     pl.seed_everything(cfg.model.seed)
     root = f"./data/{cfg.task.task}/{cfg.split.split}"
 
-    with open(f"{root}/test.pkl", 'rb') as f:
-        test = pickle.load(f)
-        if cfg.model.model == 'ecfp':
-            test = ECFPDataSplit(test, nbits=cfg.model.nbits)
-    test_loader = DataLoader(test, batch_size=cfg.model.n_batch,
-                             shuffle=False, num_workers=8)
+    test = load_split(root, 'test')
+    if cfg.model.model == 'ecfp':
+        test = ECFPDataSplit(test, **ecfp_kwargs(cfg))
 
     basepath = f"./out/{cfg.task.task}/{cfg.split.split}"
     mdir = f"{cfg.model.model}-{cfg.head.head}"
     metrics = {}
 
     for fold in range(cfg.split.n_splits):
-        # Load pickle
-        with open(f"{root}/train{fold}.pkl", 'rb') as f:
-            train = pickle.load(f)
-        with open(f"{root}/valid{fold}.pkl", 'rb') as f:
-            valid = pickle.load(f)
-        train = ECFPDataSplit(train, nbits=cfg.model.nbits)
-        valid = ECFPDataSplit(valid, nbits=cfg.model.nbits)
+        # Load split
+        train = load_split(root, 'train', fold)
+        valid = load_split(root, 'valid', fold)
+        train = ECFPDataSplit(train, **ecfp_kwargs(cfg))
+        valid = ECFPDataSplit(valid, **ecfp_kwargs(cfg))
         print('len train, val', len(train), len(valid))
 
         # configure model
@@ -58,10 +52,10 @@ def fit(cfg: DictConfig) -> None:
             model = RandomForestRegressor(n_estimators=100,
                                           random_state=42)
 
-        model.fit(train.ecfp, train.labels)
+        model.fit(train.csr(), train.labels)
 
         print('validating fold', fold)
-        valid_preds = model.predict(valid.ecfp)
+        valid_preds = model.predict(valid.csr())
         val_rmse = mean_squared_error(valid_preds, valid.labels, squared=False)
         val_mse = mean_squared_error(valid_preds, valid.labels, squared=True)
         val_mae = mean_absolute_error(valid_preds, valid.labels)
@@ -89,7 +83,7 @@ def fit(cfg: DictConfig) -> None:
     with open(f"{basepath}/{mdir}/best.pt", 'wb') as file:
         pickle.dump(model, file)
 
-    test_preds = model.predict(test.ecfp)
+    test_preds = model.predict(test.csr())
     test_rmse = mean_squared_error(test_preds, test.labels, squared=False)
     test_mse = mean_squared_error(test_preds, test.labels, squared=True)
     test_mae = mean_absolute_error(test_preds, test.labels)
@@ -10,17 +10,7 @@ import seaborn as sns
 import os
 import json
 from sklearn.metrics.pairwise import cosine_similarity
-
-
-def restore_array(st):
-    st = st.strip("'[").strip("']").split(' ')
-    st = [s for s in st if s not in ['']]
-    return np.array(st, dtype=float)
-
-
-def clean_string(st):
-    tokens = st.strip("[").strip("]").split(',')
-    return [t.replace("'", "").replace(" ", "") for t in tokens]
+from src.store import load_attributions
 
 
 def explode_attribs(models=None):
@@ -45,19 +35,18 @@ def explode_attribs(models=None):
     for mdir in models:
         try:
             print(mdir)
-            df = pd.read_csv(f"{basepath}/{mdir}/attributions.csv")
+            store = load_attributions(f"{basepath}/{mdir}")
             if 'avg' in mdir:
                 # SHAP for -avg-
-                df['rel_weights'] = df['shap_weights'].apply(restore_array)
-                df['uid'] = range(len(df))
-                df['tokens'] = df['tokens'].apply(clean_string)
+                df = store.to_frame(['uid', 'tokens', 'shap_weights'])
+                df = df.rename(columns={'shap_weights': 'rel_weights'})
             elif 'ecfp' in mdir:
                 # ECFP
-                df['rel_weights'] = df['atom_weights'].apply(restore_array)
+                df = store.to_frame(['uid', 'smiles', 'atom_weights'])
+                df = df.rename(columns={'atom_weights': 'rel_weights'})
             else:
                 # <R> for ours
-                df['rel_weights'] = df['rel_weights'].apply(restore_array)
-                df['tokens'] = df['tokens'].apply(clean_string)
+                df = store.to_frame(['uid', 'tokens', 'rel_weights'])
 
             # explode (pivot) from one uid per row to one token-weight per row
             if 'ecfp' in mdir:
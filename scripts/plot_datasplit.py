@@ -10,8 +10,9 @@ import numpy as np
 # import seaborn as sns
 # from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
-from src.dataloader import ECFPDataSplit
+from src.dataloader import ECFPDataSplit, load_split
 from src.model import MMB_R_Featurizer, MMB_AVG_Featurizer
+from src.device import trainer_kwargs, default_device
 
 
 @hydra.main(
@@ -23,6 +24,8 @@ def plot_datasplit(cfg: DictConfig) -> None:
     print(OmegaConf.to_yaml(cfg))
 
     pl.seed_everything(cfg.model.seed)
+    # cpu threads are set before the model is loaded
+    device_args = trainer_kwargs(cfg)
     basepath = f'./out/{cfg.task.task}/{cfg.split.split}'
     mdir = f"{cfg.model.model}-{cfg.head.head}"
     ckpt_path = f"{basepath}/{mdir}/best.pt"
@@ -32,10 +35,8 @@ def plot_datasplit(cfg: DictConfig) -> None:
         best_fold = metrics['best_fold']
 
     root = f"./data/{cfg.task.task}/{cfg.split.split}"
-    with open(f"{root}/valid{best_fold}.pkl", 'rb') as f:
-        valid = pickle.load(f)
-    with open(f"{root}/test.pkl", 'rb') as f:
-        test = pickle.load(f)
+    valid = load_split(root, 'valid', best_fold)
+    test = load_split(root, 'test')
     test_loader = DataLoader(test, batch_size=cfg.model.n_batch,
                              shuffle=False, num_workers=8)
     valid_loader = DataLoader(valid, batch_size=cfg.model.n_batch,
@@ -49,10 +50,11 @@ def plot_datasplit(cfg: DictConfig) -> None:
         model.head.load_state_dict(torch.load(ckpt_path))
     elif cfg.model.model in ['mmb-avg', 'mmb-ft-avg']:
         model = MMB_AVG_Featurizer(head=head,
-                                   finetune=cfg.model.finetune)
+                                   finetune=cfg.model.finetune,
+                                   device=default_device(cfg))
     elif 'ecfp' in cfg.model.model:
-        valid_emb = np.array(ECFPDataSplit(valid).ecfp)
-        test_emb = np.array(ECFPDataSplit(test).ecfp)
+        valid_emb = np.array(ECFPDataSplit(valid, cache_dir='./data/ecfp').ecfp)
+        test_emb = np.array(ECFPDataSplit(test, cache_dir='./data/ecfp').ecfp)
 
     if cfg.model.finetune or 'ft' in cfg.model.model:
         mmb_path = f"{basepath}/{mdir}/best_mmb.pt"
@@ -61,9 +63,7 @@ def plot_datasplit(cfg: DictConfig) -> None:
 
     if 'mmb' in cfg.model.model:
         trainer = pl.Trainer(
-            accelerator='gpu',
-            gpus=1,
-            precision=16,
+            **device_args,
         )
         valid_emb = trainer.predict(model, valid_loader)
         test_emb = trainer.predict(model, test_loader)
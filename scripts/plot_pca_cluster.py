@@ -12,7 +12,8 @@ from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans
 # from src.dataloader import ECFPDataSplit
 from src.model import MMB_R_Featurizer, MMB_AVG_Featurizer
-from src.dataloader import ECFPDataSplit
+from src.dataloader import ECFPDataSplit, load_split
+from src.device import trainer_kwargs, default_device
 import os
 from mpl_toolkits.axes_grid1 import ImageGrid
 from PIL import Image
@@ -28,6 +29,8 @@ def plot_pca_cluster(cfg: DictConfig) -> None:
     print(OmegaConf.to_yaml(cfg))
 
     pl.seed_everything(cfg.model.seed)
+    # cpu threads are set before the model is loaded
+    device_args = trainer_kwargs(cfg)
     basepath = f'./final/{cfg.task.task}/{cfg.split.split}'
     mdir = f"{cfg.model.model}-{cfg.head.head}"
     ckpt_path = f"{basepath}/{mdir}/best.pt"
@@ -38,10 +41,8 @@ def plot_pca_cluster(cfg: DictConfig) -> None:
     # best_fold = '1'
 
     root = f"./data/{cfg.task.task}/{cfg.split.split}"
-    with open(f"{root}/valid{best_fold}.pkl", 'rb') as f:
-        valid = pickle.load(f)
-    with open(f"{root}/test.pkl", 'rb') as f:
-        test = pickle.load(f)
+    valid = load_split(root, 'valid', best_fold)
+    test = load_split(root, 'test')
     test_loader = DataLoader(test, batch_size=cfg.model.n_batch,
                              shuffle=False, num_workers=8)
     valid_loader = DataLoader(valid, batch_size=cfg.model.n_batch,
@@ -55,10 +56,11 @@ def plot_pca_cluster(cfg: DictConfig) -> None:
         model.head.load_state_dict(torch.load(ckpt_path))
     elif cfg.model.model in ['mmb-avg', 'mmb-ft-avg']:
         model = MMB_AVG_Featurizer(head=head,
-                                   finetune=cfg.model.finetune)
+                                   finetune=cfg.model.finetune,
+                                   device=default_device(cfg))
     elif cfg.model.model == 'ecfp':
-        valid_emb = np.array(ECFPDataSplit(valid).ecfp)
-        test_emb = np.array(ECFPDataSplit(test).ecfp)
+        valid_emb = np.array(ECFPDataSplit(valid, cache_dir='./data/ecfp').ecfp)
+        test_emb = np.array(ECFPDataSplit(test, cache_dir='./data/ecfp').ecfp)
     # else:
     #     raise NotImplementedError
 
@@ -69,9 +71,7 @@ def plot_pca_cluster(cfg: DictConfig) -> None:
 
     if 'mmb' in cfg.model.model:
         trainer = pl.Trainer(
-            accelerator='gpu',
-            gpus=1,
-            precision=16,
+            **device_args,
         )
         valid_emb = trainer.predict(model, valid_loader)
         test_emb = trainer.predict(model, test_loader)
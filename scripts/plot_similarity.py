@@ -10,12 +10,8 @@ import numpy as np
 import seaborn as sns
 import os
 import json
-from sklearn.metrics.pairwise import cosine_similarity
-
-def restore_array(st):
-    st = st.strip("'[").strip("']").split(' ')
-    st = [s for s in st if s not in ['']]
-    return np.array(st, dtype=float)
+from src.store import load_attributions, RaggedArray
+from src.store import ragged_cosine_similarity
 
 
 def plot_similarity():
@@ -39,16 +35,16 @@ def plot_similarity():
     attributions = {}
     for mdir in models:
         try:
-            df = pd.read_csv(f"{basepath}/{mdir}/attributions.csv")
-            attribs = df['atom_weights'].apply(restore_array)
+            # ragged atom weights, memory-mapped
+            attribs = load_attributions(f"{basepath}/{mdir}")['atom_weights']
             attributions[mdir] = attribs
         except FileNotFoundError:
             print(f"File not found: {basepath}/{mdir}")
             continue
 
-    attributions['all-equal'] = [
-        np.ones_like(attr) / len(attr) for attr in attribs
-    ]
+    lengths = attribs.lengths
+    attributions['all-equal'] = RaggedArray(
+        np.repeat(1. / np.maximum(lengths, 1), lengths), attribs.offsets)
 
     # sanity checking
     # for ix in list(zip(*attributions.values())):
@@ -65,40 +61,27 @@ def plot_similarity():
     #     list(zip(*attributions.values()))
     # ]
 
-    similarities = []
-    mismatch = 0
-    for ix in list(zip(*attributions.values())):
-        try:
-            similarities.append(
-                cosine_similarity(np.array(ix))
-            )
-        except:
-            print([len(i) for i in ix])
-            mismatch += 1
-            # continue
-    print('total', len(attributions['all-equal']))
-    print('mismatched:', mismatch)
-    # similarities = []
-    # attribszip = list(zip(*attributions.values()))
-    # for id, ix in enumerate(attribszip):
-    #     # print(ix)
-    #     # print(id)
-    #     tmp = [len(i) for i in ix]
-    #     if not np.all(tmp[0] == tmp):
-    #         print(tmp)
-    #     # print(ix)
-    #     # print(len(cosine_similarity(np.array(ix))))
-    #
-    #     # similarities.append(
-    #     #     cosine_similarity(np.array(ix))
-    #     # )
-    # print(similarities)
-
-    similarity_matrix = np.mean(np.array(similarities), axis=0)
+    # [n_molecules, n_models, n_models] in one pass over flat buffers
+    sims, valid = ragged_cosine_similarity(list(attributions.values()))
+    similarities = sims[valid]
+    print('total', len(valid))
+    print('mismatched:', int((~valid).sum()))
+
+    # per-molecule atom counts of every model where they disagree
+    n = len(valid)
+    mismatches = pd.DataFrame({
+        mdir: attr.lengths[:n] for mdir, attr in attributions.items()})
+    mismatches.insert(0, 'uid', range(n))
+    mismatches = mismatches[~valid]
+    print(mismatches.to_string(index=False))
+    mismatches.to_csv(
+        f"{basepath}/attribution_mismatch_{cfg.split.split}.csv", index=False)
+
+    similarity_matrix = np.mean(similarities, axis=0)
 
     print(len(similarities))
-    print(np.array(similarities))
-    print(np.array(similarities).shape)
+    print(similarities)
+    print(similarities.shape)
     mask = np.triu(np.ones_like(similarity_matrix, dtype=bool), k=1)
 
     sns.set(font_scale=1.05)
@@ -6,13 +6,16 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from itertools import chain
 from src.model import AqueousRegModel, BaselineAqueousModel, ECFPLinear
-from src.dataloader import ECFPDataSplit
+from src.dataloader import (
+    ECFPDataSplit, ecfp_kwargs, LengthBucketSampler, token_lengths, load_split
+)
 import pickle
 import hydra
 import json
 from omegaconf import OmegaConf, DictConfig
 from sklearn.linear_model import LinearRegression
 from src.explainer import ColorMapper, MolecularSelfAttentionViz
+from src.device import trainer_kwargs, default_device
 import numpy as np
 import seaborn as sns
 from sklearn.preprocessing import RobustScaler
@@ -27,6 +30,8 @@ def predict_model(cfg: DictConfig) -> None:
     print(OmegaConf.to_yaml(cfg))
 
     pl.seed_everything(cfg.model.seed)
+    # cpu threads are set before the model is loaded
+    device_args = trainer_kwargs(cfg)
     root = f"./data/{cfg.task.task}/{cfg.split.split}"
     basepath = f"./out/{cfg.task.task}/{cfg.split.split}"
     mdir = f"{cfg.model.model}-{cfg.head.head}"
@@ -42,18 +47,13 @@ def predict_model(cfg: DictConfig) -> None:
                            if k not in ['valid', 'test', 'best_fold']])
     print('best', best_fold, 'all', metrics)
 
-    with open(f"{root}/valid{best_fold}.pkl", 'rb') as f:
-        valid = pickle.load(f)
-    with open(f"{root}/test.pkl", 'rb') as f:
-        test = pickle.load(f)
+    valid = load_split(root, 'valid', best_fold)
+    test = load_split(root, 'test')
     if 'ecfp' in cfg.model.model:
-        valid = ECFPDataSplit(valid, nbits=cfg.model.nbits)
-        test = ECFPDataSplit(test, nbits=cfg.model.nbits)
-    test_loader = DataLoader(test, batch_size=cfg.model.n_batch,
-                             shuffle=False, num_workers=8)
-    valid_loader = DataLoader(valid, batch_size=cfg.model.n_batch,
-                              shuffle=False, num_workers=8)
+        valid = ECFPDataSplit(valid, **ecfp_kwargs(cfg))
+        test = ECFPDataSplit(test, **ecfp_kwargs(cfg))
 
+    samplers = {}  # LengthBucketSampler per split (mmb only)
     # if 'mmb' in cfg.model.model or ('ecfp' in cfg.model.model and cfg.head.head in ['lin', 'hier']):
     if 'mmb' in cfg.model.model or cfg.head.head in ['lin', 'hier']:
         head = cfg.head.head
@@ -65,7 +65,8 @@ def predict_model(cfg: DictConfig) -> None:
 
         elif cfg.model.model in ['mmb-avg', 'mmb-ft-avg']:
             model = BaselineAqueousModel(head=head,
-                                         finetune=cfg.model.finetune)
+                                         finetune=cfg.model.finetune,
+                                         device=default_device(cfg))
             model.head.load_state_dict(torch.load(ckpt_path))
 
         elif cfg.model.model in ['ecfp', 'ecfp2k']:
@@ -78,11 +79,32 @@ def predict_model(cfg: DictConfig) -> None:
             model.mmb.load_state_dict(torch.load(mmb_path))
             # model.head.load_state_dict(torch.load(ckpt_path))
             # model.explainer = MolecularSelfAttentionViz(save_heatmap=False)
+        if 'mmb' in cfg.model.model:
+            # predictions only, attributions are left to the explain stage
+            model.explain = False
+
+        # mmb: tokenize each batch once in the loader workers
+        collate_fn = model.collator() if 'mmb' in cfg.model.model else None
+        if 'ecfp' in cfg.model.model:
+            collate_fn = test.collate
+        # mmb: batch SMILES of similar length, restored to file order below
+        if 'mmb' in cfg.model.model and cfg.model.get('bucket', False):
+            for split, ds in [('test', test), ('valid', valid)]:
+                samplers[split] = LengthBucketSampler(token_lengths(
+                    model.tokenizer, ds.smiles, model.token_prefix),
+                    batch_size=cfg.model.n_batch)
+                samplers[split].report(split)
+        test_loader = DataLoader(test, batch_size=cfg.model.n_batch,
+                                 shuffle=False, num_workers=8,
+                                 collate_fn=collate_fn,
+                                 sampler=samplers.get('test'))
+        valid_loader = DataLoader(valid, batch_size=cfg.model.n_batch,
+                                  shuffle=False, num_workers=8,
+                                  collate_fn=collate_fn,
+                                  sampler=samplers.get('valid'))
 
         trainer = pl.Trainer(
-            accelerator='gpu',
-            gpus=1,
-            precision=16,
+            **device_args,
         )
 
         metrics[f'val_{best_fold}'] = trainer.validate(model, valid_loader)[0]
@@ -98,9 +120,9 @@ def predict_model(cfg: DictConfig) -> None:
     elif 'ecfp' in cfg.model.model and cfg.head.head in ['svr', 'rf']:
         with open(ckpt_path, 'rb') as file:
             model = pickle.load(file)
-        all_valid = {'preds': model.predict(valid.ecfp),
+        all_valid = {'preds': model.predict(valid.csr()),
                      'labels': valid.labels}
-        all_test = {'preds': model.predict(test.ecfp),
+        all_test = {'preds': model.predict(test.csr()),
                     'labels': test.labels}
 
     results = pd.DataFrame(columns=[
@@ -121,6 +143,10 @@ def predict_model(cfg: DictConfig) -> None:
         elif cfg.head.head in ['lin', 'hier']:
             preds = torch.concat([f.get('preds') for f in all]).cpu().numpy()
             labels = torch.concat([f.get('labels') for f in all]).cpu().numpy()
+        if split in samplers:
+            smiles, tokens, preds, labels = [
+                samplers[split].restore_order(v)
+                for v in (smiles, tokens, preds, labels)]
 
         res = pd.DataFrame({
             'SMILES': smiles,
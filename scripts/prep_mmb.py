@@ -9,6 +9,7 @@ import mlflow
 from src.dataloader import AqSolDataset, AqSolDeepChem
 from src.datamol_loader import * #AqueousDataMolSet, scaffold_split
 from src.model import AqueousRegModel, BaselineAqueousModel, MMBFeaturizer
+from src.device import trainer_kwargs
 
 
 from sklearn.metrics import mean_absolute_error, mean_squared_error
@@ -42,9 +43,7 @@ all_loader = DataLoader(all_dataset, batch_size=32,
     shuffle=False, num_workers=8)
 
 trainer = pl.Trainer(
-    accelerator='gpu',
-    gpus=1,
-    precision=16,
+    **trainer_kwargs(),
 )
 
 feats_mmb = trainer.predict(model, all_loader)
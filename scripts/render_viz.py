@@ -0,0 +1,58 @@
+import os
+import hydra
+from omegaconf import OmegaConf, DictConfig
+
+from src.explainer import ColorMapper, cmap_from_name
+from src.render import MoleculeRenderer
+from src.store import load_attributions
+
+
+@hydra.main(
+    version_base="1.3", config_path="../conf", config_name="config")
+def render_viz(cfg: DictConfig) -> None:
+    ''' draw attribution pngs from the attribution stores written by
+        the explain scripts, eg.
+            python scripts/render_viz.py +uids=[3,17]
+            python scripts/render_viz.py +dirs=[out/aq/scaffold/mmb-lin]
+        without dirs the model of params.yaml is rendered, without uids
+        the whole test set. drawn pngs are cached in ./out/renders.
+    '''
+    uids = cfg.get('uids', None)
+    dirs = cfg.get('dirs', None)
+
+    params = OmegaConf.load('./params.yaml')
+    print('RENDER CONFIG from params.yaml')
+    print(OmegaConf.to_yaml(params))
+    if not dirs:
+        basepath = f"./out/{params.task.task}/{params.split.split}"
+        dirs = [f"{basepath}/{params.model.model}-{params.head.head}"]
+
+    n_workers = params.xai.get('render_workers', 4)
+    for outdir in dirs:
+        if not os.path.exists(f"{outdir}/attributions/meta.json"):
+            print(f"no attribution store in {outdir}, run explain first")
+            continue
+        store = load_attributions(outdir)
+        rows = range(len(store))
+        if uids is not None:
+            uids = {int(uid) for uid in uids}
+            rows = [i for i, uid in enumerate(store['uid'])
+                    if int(uid) in uids]
+
+        cmapper = ColorMapper(cmap=cmap_from_name(store.get('cmap')))
+        renderer = MoleculeRenderer(n_workers,
+                                    partial=store.get('partial', False),
+                                    cache_dir='./out/renders')
+        for i in rows:
+            weight = store['atom_weights'][i]
+            if store.get('normalize', False):
+                weight = cmapper.div_norm(weight)
+            renderer.submit(
+                str(store['smiles'][i]), cmapper.to_rdkit_cmap(weight),
+                f"{outdir}/viz/" + store.get('viz').format(uid=store['uid'][i]))
+        print(f"{outdir}: {len(rows)} molecules")
+        renderer.run()
+
+
+if __name__ == "__main__":
+    render_viz()
@@ -1,6 +1,7 @@
 import pytorch_lightning as pl
 # from src.dataloader import *
-import pickle
+from src.dataloader import save_splits, load_split
+import numpy as np
 import pandas as pd
 import dvc.api
 import hydra
@@ -22,35 +23,39 @@ def split(cfg: DictConfig) -> None:
     module = importlib.import_module('src.dataloader')
     DatasetLoader = getattr(module, cfg.task.loader)
 
-    train_ds = DatasetLoader('train',
+    # read, preprocess and split once: test + all train/valid folds
+    splits = DatasetLoader('all',
         cfg.task.filepath, cfg.task.smilesname, cfg.task.propname,
         cfg.split.split, cfg.split.split_frac, cfg.split.n_splits,
-        cfg.split.data_seed, cfg.split.scale, augment=False)
-    valid_ds = DatasetLoader('valid',
-        cfg.task.filepath, cfg.task.smilesname, cfg.task.propname,
-        cfg.split.split, cfg.split.split_frac, cfg.split.n_splits,
-        cfg.split.data_seed, cfg.split.scale)
-    test_ds = DatasetLoader('test',
-        cfg.task.filepath, cfg.task.smilesname, cfg.task.propname,
-        cfg.split.split, cfg.split.split_frac, cfg.split.n_splits,
-        cfg.split.data_seed, cfg.split.scale)
+        cfg.split.data_seed, cfg.split.scale, augment=False,
+        # scaffolds are cached per SMILES across datasets, splits, seeds
+        scaffold_workers=cfg.split.get('scaffold_workers', 8),
+        scaffold_cache=cfg.split.get('scaffold_cache',
+                                     './data/murcko_scaffolds.pkl'))
 
-    test = test_ds[:]
+    # columnar, memory-mapped split files: rows are test then train+valid,
+    # folds are row indices into them
+    test = splits.test
+    tr_va = splits.tr_va_df
+    n_test = len(test)
+    subsets = {'test': np.arange(n_test)}
+    for fold, (train_idx, val_idx) in enumerate(splits.folds):
+        subsets[f"train{fold}"] = n_test + np.asarray(train_idx)
+        subsets[f"valid{fold}"] = n_test + np.asarray(val_idx)
+    save_splits(root,
+                list(test.smiles) + tr_va[cfg.task.smilesname].to_list(),
+                np.concatenate([test.labels.numpy(),
+                                tr_va[cfg.task.propname].to_numpy()]),
+                subsets)
     print(len(test), 'test len')
-    with open(f"{root}/test.pkl", 'wb') as f:
-        pickle.dump(test, f)
 
     for fold in range(cfg.split.n_splits):
-        train = train_ds[fold]
-        with open(f"{root}/train{fold}.pkl", 'wb') as f:
-            pickle.dump(train, f)
-            print(len(train), 'train len', fold)
+        train = load_split(root, 'train', fold)
+        print(len(train), 'train len', fold)
 
     for fold in range(cfg.split.n_splits):
-        valid = valid_ds[fold]
-        with open(f"{root}/valid{fold}.pkl", 'wb') as f:
-            pickle.dump(valid, f)
-            print(len(valid), 'valid len', fold)
+        valid = load_split(root, 'valid', fold)
+        print(len(valid), 'valid len', fold)
 
     # write split into csv for reproducibility
     propname = cfg.task.propname
@@ -8,6 +8,7 @@ import dagshub
 import mlflow
 from src.dataloader import CombiSoluDataset
 from src.model import CombiRegModel
+from src.device import trainer_kwargs
 
 with open('/workspace/scripts/combi_config.json', 'r') as f:
     cfg = json.load(f)
@@ -36,9 +37,7 @@ dagshub.init("Chemical_Language_Model_Explainer", "stefanhoedl", mlflow=True)
 
 trainer = pl.Trainer(
     max_epochs=cfg['n_epochs'],
-    accelerator='gpu',
-    gpus=1,
-    precision=16,
+    **trainer_kwargs(),
     auto_lr_find=True,
 )
 
@@ -4,9 +4,15 @@ import pytorch_lightning as pl
 from pytorch_lightning.loggers import WandbLogger
 import wandb
 from src.model import (
-    AqueousRegModel, BaselineAqueousModel, ECFPLinear
+    AqueousRegModel, BaselineAqueousModel, ECFPLinear, EmbeddingRegModel
 )
-from src.dataloader import ECFPDataSplit
+from src.dataloader import (
+    ECFPDataSplit, EmbeddingDataSplit, LengthBucketSampler, token_lengths,
+    ecfp_kwargs, load_split
+)
+from src.cache import FeatureCache
+from src.device import trainer_kwargs, default_device
+from nemo_src.regex_tokenizer import RegExTokenizer
 import pickle
 import json
 import numpy as np
@@ -24,32 +30,96 @@ def train(cfg: DictConfig) -> None:
     print(OmegaConf.to_yaml(cfg))
 
     pl.seed_everything(cfg.model.seed)
+    # cpu threads are set before the model is loaded
+    device_args = trainer_kwargs(cfg)
     root = f"./data/{cfg.task.task}/{cfg.split.split}"
 
-    with open(f"{root}/test.pkl", 'rb') as f:
-        test = pickle.load(f)
-        if 'ecfp' in cfg.model.model:
-            test = ECFPDataSplit(test, nbits=cfg.model.nbits)
+    test = load_split(root, 'test')
+    if 'ecfp' in cfg.model.model:
+        test = ECFPDataSplit(test, **ecfp_kwargs(cfg))
+
+    # frozen encoder: encode each unique SMILES once, train only the head
+    cache_feats = 'mmb' in cfg.model.model and not cfg.model.finetune \
+        and cfg.model.get('cache_feats', False)
+    collate_fn = None
+    if 'ecfp' in cfg.model.model:
+        # on-bit index bags, gathered by ECFPLinear.forward_sparse
+        collate_fn = test.collate
+    if cache_feats and cfg.head.head not in EmbeddingRegModel.heads:
+        raise ValueError(
+            f"cache_feats trains {EmbeddingRegModel.heads} heads only, "
+            f"got head={cfg.head.head}: set model.cache_feats=false")
+    if cache_feats:
+        if cfg.model.model == 'mmb':
+            encoder = AqueousRegModel(head=cfg.head.head, finetune=False)
+            encoder.to(default_device(cfg))
+            pooling = 'reg'
+        elif cfg.model.model == 'mmb-avg':
+            encoder = BaselineAqueousModel(head=cfg.head.head,
+                                           finetune=False,
+                                           device=default_device(cfg))
+            pooling = 'avg'
+        smiles = list(test.smiles)
+        for fold in range(cfg.split.n_splits):
+            for subset in ['train', 'valid']:
+                smiles += list(load_split(root, subset, fold).smiles)
+        cache = FeatureCache(f"./data/{cfg.task.task}/feats",
+                             cfg.model.model, encoder.feature_key())
+        encoder.fill_feature_cache(cache, smiles, cfg.model.n_batch)
+        del encoder
+        torch.cuda.empty_cache()
+
+        def cached(ds):
+            feats, lengths = cache.lookup(ds.smiles)
+            return EmbeddingDataSplit(ds, feats, lengths, pooling=pooling)
+        test = cached(test)
+        collate_fn = test.collate
+
+    # mmb on SMILES: batch similar token lengths to cut padding
+    bucket = 'mmb' in cfg.model.model and not cache_feats \
+        and cfg.model.get('bucket', False)
+    if bucket:
+        tokenizer = RegExTokenizer().load_tokenizer()
+        prefix = BaselineAqueousModel.token_prefix \
+            if 'avg' in cfg.model.model else AqueousRegModel.token_prefix
+
+    def sampler(ds, name, shuffle=False):
+        if not bucket:
+            return None
+        bucket_sampler = LengthBucketSampler(
+            token_lengths(tokenizer, ds.smiles, prefix),
+            batch_size=cfg.model.n_batch, shuffle=shuffle,
+            seed=cfg.model.seed)
+        bucket_sampler.report(name)
+        return bucket_sampler
+
     test_loader = DataLoader(test, batch_size=cfg.model.n_batch,
-                             shuffle=False, num_workers=2)
+                             shuffle=False, num_workers=2,
+                             collate_fn=collate_fn,
+                             sampler=sampler(test, 'test'))
 
     basepath = f"./out/{cfg.task.task}/{cfg.split.split}"
     mdir = f"{cfg.model.model}-{cfg.head.head}"
     metrics = {}
     for fold in range(cfg.split.n_splits):
-        # Load pickle
-        with open(f"{root}/train{fold}.pkl", 'rb') as f:
-            train = pickle.load(f)
-        with open(f"{root}/valid{fold}.pkl", 'rb') as f:
-            valid = pickle.load(f)
+        # Load split
+        train = load_split(root, 'train', fold)
+        valid = load_split(root, 'valid', fold)
         if 'ecfp' in cfg.model.model:
-            train = ECFPDataSplit(train, nbits=cfg.model.nbits)
-            valid = ECFPDataSplit(valid, nbits=cfg.model.nbits)
+            train = ECFPDataSplit(train, **ecfp_kwargs(cfg))
+            valid = ECFPDataSplit(valid, **ecfp_kwargs(cfg))
+        if cache_feats:
+            train, valid = cached(train), cached(valid)
         print('len train, val', len(train), len(valid))
+        train_sampler = sampler(train, f"train{fold}", shuffle=True)
         train_loader = DataLoader(train, batch_size=cfg.model.n_batch,
-                                  shuffle=True, num_workers=8)
+                                  shuffle=train_sampler is None,
+                                  num_workers=8, collate_fn=collate_fn,
+                                  sampler=train_sampler)
         valid_loader = DataLoader(valid, batch_size=cfg.model.n_batch,
-                                  shuffle=False, num_workers=8)
+                                  shuffle=False, num_workers=8,
+                                  collate_fn=collate_fn,
+                                  sampler=sampler(valid, f"valid{fold}"))
 
         # configure model
         # if 'ecfp' in cfg.model.model and cfg.head.head in ['svr', 'rf']:
@@ -58,13 +128,17 @@ def train(cfg: DictConfig) -> None:
         #     model.fit(train.ecfp, train.labels)
 
         if fold == 0:
-            if cfg.model.model in ['mmb', 'mmb-ft']:
+            if cache_feats:
+                # head state_dict is saved as for AqueousRegModel.head
+                model = EmbeddingRegModel(head=cfg.head.head)
+            elif cfg.model.model in ['mmb', 'mmb-ft']:
                 model = AqueousRegModel(head=cfg.head.head,
                                         finetune=cfg.model.finetune)
                 # _sanity_mmb = np.array(model.mmb.state_dict())
             elif cfg.model.model in ['mmb-avg', 'mmb-ft-avg']:
                 model = BaselineAqueousModel(head=cfg.head.head,
-                                             finetune=cfg.model.finetune)
+                                             finetune=cfg.model.finetune,
+                                             device=default_device(cfg))
             elif 'ecfp' in cfg.model.model and cfg.head.head in ['lin', 'hier']:
                 model = ECFPLinear(head=cfg.head.head,
                                    dim=cfg.model.nbits)
@@ -76,7 +150,7 @@ def train(cfg: DictConfig) -> None:
         else:
             # only reset head instead of re-initializing full mmb model
             model.reset_head()
-            if 'mmb' in cfg.model.model:
+            if 'mmb' in cfg.model.model and not cache_feats:
                 model.mmb.freeze()
             if cfg.model.finetune or 'ft' in cfg.model.model:
                 # restore base MMB core
@@ -98,9 +172,7 @@ def train(cfg: DictConfig) -> None:
 
         trainer = pl.Trainer(
             max_epochs=cfg.model.n_epochs,
-            accelerator='gpu' if torch.cuda.is_available() else 'cpu',
-            gpus=1 if torch.cuda.is_available() else 0,
-            precision=16 if torch.cuda.is_available() else 32,
+            **device_args,
             logger=wandb_logger,
             auto_lr_find=False,
         )
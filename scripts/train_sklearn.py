@@ -6,7 +6,7 @@ import pytorch_lightning as pl
 # from src.model import (
 #     ECFPModel
 # )
-from src.dataloader import ECFPDataSplit
+from src.dataloader import ECFPDataSplit, ecfp_kwargs, load_split
 import pickle
 import json
 import numpy as np
@@ -17,7 +17,6 @@ from sklearn.ensemble import RandomForestRegressor
 # from sklearn.svm import SVR
 from sverad.sverad_svm import ExplainingSVR
 from sklearn.model_selection import GridSearchCV
-from scipy.sparse import csr_matrix
 
 def evaluate(preds, labels, prefix=''):
     metric = {}
@@ -43,42 +42,37 @@ def train_sklearn(cfg: DictConfig) -> None:
     pl.seed_everything(cfg.model.seed)
     root = f"./data/{cfg.task.task}/{cfg.split.split}"
 
-    with open(f"{root}/test.pkl", 'rb') as f:
-        test = pickle.load(f)
-        if 'ecfp' in cfg.model.model:
-            test = ECFPDataSplit(test, nbits=cfg.model.nbits)
-            print(test.ecfp.shape, test.labels.shape)
+    test = load_split(root, 'test')
+    if 'ecfp' in cfg.model.model:
+        test = ECFPDataSplit(test, **ecfp_kwargs(cfg))
+        print(test.packed.shape, test.labels.shape)
 
     basepath = f"./out/{cfg.task.task}/{cfg.split.split}"
     mdir = f"{cfg.model.model}-{cfg.head.head}"
     metrics = {}
 
     for fold in range(cfg.split.n_splits):
-        # Load pickle
-        with open(f"{root}/train{fold}.pkl", 'rb') as f:
-            train = pickle.load(f)
-        with open(f"{root}/valid{fold}.pkl", 'rb') as f:
-            valid = pickle.load(f)
-        train = ECFPDataSplit(train, nbits=cfg.model.nbits)
-        valid = ECFPDataSplit(valid, nbits=cfg.model.nbits)
+        # Load split
+        train = load_split(root, 'train', fold)
+        valid = load_split(root, 'valid', fold)
+        train = ECFPDataSplit(train, **ecfp_kwargs(cfg))
+        valid = ECFPDataSplit(valid, **ecfp_kwargs(cfg))
         print('len train, val', len(train), len(valid))
 
         # configure model
         assert 'ecfp' in cfg.model.model and cfg.head.head in ['svr', 'rf']
         if cfg.head.head == 'svr':
             model = ExplainingSVR(C=1.0)
-            train.ecfp = csr_matrix(train.ecfp)
-            valid.ecfp = csr_matrix(valid.ecfp)
-            test.ecfp = csr_matrix(test.ecfp)
         elif cfg.head.head == 'rf':
             model = RandomForestRegressor(n_estimators=200,
                                           min_samples_split=2,
                                           min_samples_leaf=1,
                                           random_state=42)
 
-        print('ecfptrain', train.ecfp.shape)
+        # csr from the on-bit indices, no dense fingerprints
+        print('ecfptrain', train.csr().shape)
         print('lab', train.labels.shape)
-        model.fit(train.ecfp, train.labels)
+        model.fit(train.csr(), train.labels)
 
         # param_grid = {
         #     'C': [1, 10, 100, 1000],
@@ -90,7 +84,7 @@ def train_sklearn(cfg: DictConfig) -> None:
         # print("Best parameters:", grid_search.best_params_)
 
         print('validating fold', fold)
-        valid_preds = model.predict(valid.ecfp)
+        valid_preds = model.predict(valid.csr())
         metrics[fold] = evaluate(valid_preds, valid.labels, 'val')
 
         path = f"{basepath}/{mdir}/model/head{fold}.pt"
@@ -111,7 +105,7 @@ def train_sklearn(cfg: DictConfig) -> None:
     with open(f"{basepath}/{mdir}/best.pt", 'wb') as file:
         pickle.dump(model, file)
 
-    test_preds = model.predict(test.ecfp)
+    test_preds = model.predict(test.csr())
     metrics['test'] = evaluate(test_preds, test.labels, 'test')
     print(metrics)
     with open(f"{basepath}/{mdir}/metrics.json", 'w') as f:
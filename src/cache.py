@@ -0,0 +1,269 @@
+import os
+import glob
+import pickle
+import hashlib
+import torch
+import numpy as np
+from collections import OrderedDict
+from typing import List
+
+
+def hash_bytes(*chunks):
+    ''' short sha1 hex digest over str/bytes chunks '''
+    h = hashlib.sha1()
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def hash_tokenizer(tokenizer):
+    ''' hash regex + vocab of a RegExTokenizer '''
+    vocab = ','.join(f"{t}:{i}" for t, i in sorted(tokenizer.vocab.items()))
+    return hash_bytes(tokenizer.regex, vocab)
+
+
+def hash_state_dict(state_dict):
+    ''' hash names + values of a (module) state_dict '''
+    h = hashlib.sha1()
+    for name in sorted(state_dict.keys()):
+        h.update(name.encode())
+        value = state_dict[name]
+        if torch.is_tensor(value):
+            value = value.detach().cpu().float().numpy().tobytes()
+        h.update(str(value).encode() if not isinstance(value, bytes)
+                 else value)
+    return h.hexdigest()[:16]
+
+
+def hash_file(path):
+    ''' hash file contents, eg. a checkpoint '''
+    with open(path, 'rb') as f:
+        return hash_bytes(f.read())
+
+
+class FeatureCache():
+    ''' per-SMILES encoder features persisted in one torch file.
+        the file name carries the model name and a hash of
+        tokenizer + encoder weights, so stale features are never reused.
+    '''
+
+    def __init__(self, root, name, key):
+        self.path = f"{root}/{name}-{key}.pt"
+        self.index = {}
+        self.feats = torch.empty(0)
+        self.lengths = torch.empty(0, dtype=torch.int64)
+        if os.path.exists(self.path):
+            stored = torch.load(self.path)
+            self.index = {smi: i for i, smi in enumerate(stored['smiles'])}
+            self.feats = stored['feats']
+            self.lengths = stored['lengths']
+        print(f"feature cache {self.path}: {len(self.index)} entries")
+
+    def __len__(self):
+        return len(self.index)
+
+    def missing(self, smiles: List[str]):
+        ''' unique SMILES without cached features, in first-seen order '''
+        return [smi for smi in dict.fromkeys(smiles) if smi not in self.index]
+
+    def update(self, smiles: List[str], feats, lengths):
+        offset = len(self.index)
+        for i, smi in enumerate(smiles):
+            self.index[smi] = offset + i
+        feats, lengths = feats.float().cpu(), lengths.cpu()
+        if offset == 0:
+            self.feats, self.lengths = feats, lengths
+        else:
+            self.feats = torch.cat([self.feats, feats])
+            self.lengths = torch.cat([self.lengths, lengths])
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        torch.save({'smiles': list(self.index.keys()),
+                    'feats': self.feats,
+                    'lengths': self.lengths}, self.path)
+
+    def lookup(self, smiles: List[str]):
+        ''' returns feats [n, dim], lengths [n] for smiles '''
+        idx = torch.tensor([self.index[smi] for smi in smiles],
+                           dtype=torch.int64)
+        return self.feats[idx], self.lengths[idx]
+
+
+class SmilesCache():
+    ''' one value per input SMILES in a pickle, shared by all datasets,
+        splits and seeds. path=None keeps it in memory only.
+    '''
+    name = 'smiles'
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.entries = pickle.load(f)
+        self.n_loaded = len(self.entries)
+        print(f"{self.name} cache {path}: {self.n_loaded} entries")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def missing(self, smiles: List[str]):
+        ''' unique SMILES without a cached value, in first-seen order '''
+        return [smi for smi in dict.fromkeys(smiles)
+                if smi not in self.entries]
+
+    def update(self, smiles: List[str], values):
+        self.entries.update(zip(smiles, values))
+
+    def lookup(self, smiles: List[str]):
+        return [self.entries[smi] for smi in smiles]
+
+    def save(self):
+        if not self.path or len(self.entries) == self.n_loaded:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.entries, f)
+        os.replace(tmp, self.path)
+        self.n_loaded = len(self.entries)
+
+
+class ScaffoldCache(SmilesCache):
+    ''' murcko-* scaffold per input SMILES '''
+    name = 'scaffold'
+
+
+class ECFPCache(SmilesCache):
+    ''' bit-packed morgan fingerprint (uint8 bytes) per input SMILES,
+        one pickle per radius and nbits in root (None: in memory only) '''
+    name = 'ecfp'
+
+    def __init__(self, root=None, radius=2, nbits=512):
+        self.radius, self.nbits = radius, nbits
+        super().__init__(f"{root}/ecfp-r{radius}-{nbits}.pkl" if root
+                         else None)
+
+    def update(self, smiles: List[str], packed):
+        super().update(smiles, [bytes(row) for row in packed])
+
+    def lookup(self, smiles: List[str]):
+        ''' packed fingerprints [n, ceil(nbits / 8)] uint8 '''
+        n_bytes = (self.nbits + 7) // 8
+        return np.frombuffer(b''.join(super().lookup(smiles)),
+                             dtype=np.uint8).reshape(len(smiles), n_bytes)
+
+
+class LRUCache():
+    ''' bounded least recently used dict with hit/miss counters,
+        max_entries=0 disables caching '''
+
+    def __init__(self, max_entries=200000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not self.max_entries:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __repr__(self):
+        return (f"{len(self)} entries, {self.hits} hits, {self.misses} misses "
+                f"({self.hit_rate():.1%})")
+
+
+class AttributionCache():
+    ''' per-molecule attributions (preds, rel_weights, atom_weights, ...)
+        keyed by the input SMILES, persisted in one pickle per model
+        fingerprint (key). tokens and atom order follow the input string,
+        so entries are not shared between spellings of a molecule.
+        least recently used entries beyond max_entries are evicted on save,
+        the oldest stores of the same name beyond max_stores.
+        root=None keeps the cache in memory only.
+    '''
+
+    def __init__(self, root, name, key, max_entries=100000, max_stores=16):
+        self.root, self.name = root, name
+        self.path = f"{root}/{name}-{key}.pkl" if root else None
+        self.max_entries = max_entries
+        self.max_stores = max_stores
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.changed = False
+        if self.path and os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                stored = pickle.load(f)
+            # stores written under canonical keys: re-key by input SMILES
+            self.entries = OrderedDict(
+                (entry['smiles'], entry) for entry in stored.values())
+        print(f"attribution cache {self.path}: {len(self.entries)} entries")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def peek(self, smi):
+        return self.entries.get(smi)
+
+    def get(self, smi):
+        entry = self.peek(smi)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(smi)
+        self.hits += 1
+        return entry
+
+    def missing(self, smiles: List[str]):
+        ''' unique SMILES without cached attributions, in first-seen order '''
+        return [smi for smi in dict.fromkeys(smiles) if smi not in self.entries]
+
+    def put(self, smi, **values):
+        self.entries[smi] = {'smiles': smi, **values}
+        self.entries.move_to_end(smi)
+        self.changed = True
+
+    def update(self, smiles: List[str], **values):
+        ''' values: lists aligned with smiles, eg. preds=[...] '''
+        for i, smi in enumerate(smiles):
+            self.put(smi, **{k: v[i] for k, v in values.items()})
+
+    def lookup(self, smiles: List[str]):
+        return [self.get(smi) for smi in smiles]
+
+    def save(self):
+        print(f"attribution cache: {self.hits} hits, {self.misses} misses")
+        if not self.path or not self.changed:
+            return
+        # evict only here: a run may still look up what it put
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.path, 'wb') as f:
+            pickle.dump(self.entries, f)
+        self.changed = False
+        stores = sorted(glob.glob(f"{self.root}/{self.name}-*.pkl"),
+                        key=os.path.getmtime, reverse=True)
+        for stale in stores[self.max_stores:]:
+            os.remove(stale)
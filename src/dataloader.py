@@ -1,12 +1,20 @@
+import os
+import json
+import functools
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+from torch.utils.data.dataloader import default_collate
 from rdkit import Chem
-from rdkit.Chem import AllChem
+from rdkit.Chem import AllChem, rdFingerprintGenerator
 import pandas as pd
 import numpy as np
 from sklearn.model_selection import GroupShuffleSplit, ShuffleSplit
 from rdkit.Chem.Scaffolds import MurckoScaffold
-from typing import List
+from typing import List, NamedTuple, Optional
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix
+from src.cache import ScaffoldCache, ECFPCache
+from src.store import RaggedArray
 from sklearn.preprocessing import (
     StandardScaler, RobustScaler, QuantileTransformer, MinMaxScaler
 )
@@ -14,7 +22,8 @@ from sklearn.preprocessing import (
 class PropertyDataset(Dataset):
     def __init__(self, subset, file_path, smilesname, propname,
                  split, split_frac, n_splits=5, data_seed=42,
-                 scale=False, augment=False):
+                 scale=False, augment=False, scaffold_workers=0,
+                 scaffold_cache=None):
         self.subset = subset
         self.split = split
         self.split_frac = split_frac
@@ -51,7 +60,9 @@ class PropertyDataset(Dataset):
                 smiles=df[smilesname].to_list(),
                 n_splits=5,
                 test_size=1.-self.split_frac,
-                seed=self.data_seed
+                seed=self.data_seed,
+                n_workers=scaffold_workers,
+                cache=scaffold_cache
             )
         else:
             test_splitter = splitter
@@ -115,37 +126,40 @@ class PropertyDataset(Dataset):
             assert len(set(test_df[smilesname].to_list()) ^
                        set(sane_test[smilesname].to_list())) == 0
 
-        if self.subset == 'test':
-            self.data = DataSplit(
-                    smiles=test_df[smilesname].to_list(),
-                    labels=torch.tensor(
-                        test_df[propname].to_list(),
-                        dtype=torch.float32),
-                    subset=self.subset
-                )
-        else:
-            # split remaining df into train/val
-            self.tr_va_splitter = splitter.split(
-                tr_va_df[smilesname].to_list())
-
-            self.data = []
-            for fold in range(self.n_splits):
-                train_idx, val_idx = next(self.tr_va_splitter)
-                assert len(train_idx) > len(val_idx)
-                if self.subset == 'train':
-                    df = self.tr_va_df.iloc[train_idx]
-                elif self.subset == 'valid':
-                    df = self.tr_va_df.iloc[val_idx]
-
-                self.data.append(
+        # test set and all train/valid folds from this one frame,
+        # subset='all' keeps them all (see split_data.py)
+        self.test = DataSplit(
+                smiles=test_df[smilesname].to_list(),
+                labels=torch.tensor(
+                    test_df[propname].to_list(),
+                    dtype=torch.float32),
+                subset='test'
+            )
+
+        # split remaining df into train/val
+        self.tr_va_splitter = splitter.split(
+            tr_va_df[smilesname].to_list())
+
+        self.train, self.valid, self.folds = [], [], []
+        for fold in range(self.n_splits):
+            train_idx, val_idx = next(self.tr_va_splitter)
+            assert len(train_idx) > len(val_idx)
+            self.folds.append((train_idx, val_idx))
+            for data, idx, name in [(self.train, train_idx, 'train'),
+                                    (self.valid, val_idx, 'valid')]:
+                df = self.tr_va_df.iloc[idx]
+                data.append(
                     DataSplit(
                         smiles=df[smilesname].to_list(),
                         labels=torch.tensor(
                             df[propname].to_list(),
                             dtype=torch.float16),
-                        subset=self.subset)
+                        subset=name)
                     )
 
+        self.data = {'test': self.test, 'train': self.train,
+                     'valid': self.valid}.get(self.subset)
+
     def __len__(self):
         return len(self.data)
 
@@ -180,48 +194,510 @@ class DataSplit(Dataset):
         return data, labels
 
 
+class SmilesColumn():
+    """ SMILES of a split as rows of one memory-mapped utf-8 buffer
+        (smiles.bytes.npy + smiles.offsets.npy), picked by a memory-mapped
+        index array ({name}.idx.npy). DataLoader workers share the pages,
+        pickling only passes the paths.
+    """
+
+    def __init__(self, root, name=None):
+        self.root = root
+        self.name = name
+        self.data = np.load(f"{root}/smiles.bytes.npy", mmap_mode='r')
+        self.offsets = np.load(f"{root}/smiles.offsets.npy", mmap_mode='r')
+        self.idx = np.load(f"{root}/{name}.idx.npy", mmap_mode='r') \
+            if name else None
+
+    def __reduce__(self):
+        return (SmilesColumn, (self.root, self.name))
+
+    def __len__(self):
+        return len(self.idx) if self.idx is not None \
+            else len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        row = self.idx[i] if self.idx is not None else i
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.data[start:end].tobytes().decode()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def save_splits(root, smiles: List[str], labels, subsets):
+    """ columnar split format: all rows once (smiles buffer + offsets,
+        float32 labels) and row indices per subset, eg. test, train0, ...
+    """
+    os.makedirs(root, exist_ok=True)
+    encoded = [smi.encode() for smi in smiles]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    np.save(f"{root}/smiles.bytes.npy",
+            np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(f"{root}/smiles.offsets.npy", offsets)
+    np.save(f"{root}/labels.npy", np.asarray(labels, dtype=np.float32))
+    for name, idx in subsets.items():
+        np.save(f"{root}/{name}.idx.npy", np.asarray(idx, dtype=np.int64))
+    with open(f"{root}/splits.json", 'w') as f:
+        json.dump({'n': len(encoded),
+                   'subsets': {k: len(v) for k, v in subsets.items()}},
+                  f, indent=1)
+
+
+def load_split(root, subset, fold=None):
+    """ DataSplit of test, or train/valid of a fold, from save_splits.
+        labels: float32 for test, float16 for train/valid as before """
+    name = subset if fold is None else f"{subset}{fold}"
+    smiles = SmilesColumn(root, name)
+    labels = np.load(f"{root}/labels.npy", mmap_mode='r')[smiles.idx]
+    dtype = torch.float32 if subset == 'test' else torch.float16
+    return DataSplit(smiles=smiles,
+                     labels=torch.from_numpy(labels).to(dtype),
+                     subset=subset)
+
+
+class TokenizedBatch(NamedTuple):
+    """ SMILES batch tokenized once: token strings (without prefix),
+        padded token ids and encoder masks [batch, pad_length] """
+    smiles: List[str]
+    tokens: List[List[str]]
+    ids: torch.Tensor
+    masks: torch.Tensor
+
+
+def pad_batch(smiles, tokens, token_ids, pad_id):
+    ''' pad token id lists into a TokenizedBatch (cpu tensors) '''
+    pad_length = max([len(seq) for seq in token_ids])
+    encoder_masks = [([1] * len(seq)) + ([0] * (pad_length - len(seq)))
+                     for seq in token_ids]
+    token_ids = [seq + ([pad_id] * (pad_length - len(seq)))
+                 for seq in token_ids]
+    return TokenizedBatch(
+        smiles=list(smiles),
+        tokens=tokens,
+        ids=torch.tensor(token_ids, dtype=torch.int64),
+        masks=torch.tensor(encoder_masks, dtype=torch.int64))
+
+
+def tokenize_batch(tokenizer, smiles, prefix=()):
+    ''' tokenize SMILES, prepend prefix tokens (eg. <REG>) and pad '''
+    tokens = [tokenizer.text_to_tokens(s) for s in smiles]
+    token_ids = [tokenizer.token_to_ids(list(prefix) + t) for t in tokens]
+    return pad_batch(smiles, tokens, token_ids, tokenizer.pad_id)
+
+
+class SmilesCollator():
+    """ DataLoader collate_fn: (smiles, label) items to
+        (TokenizedBatch, labels), tokenized once in the loader workers """
+
+    def __init__(self, tokenizer, prefix=()):
+        self.tokenizer = tokenizer
+        self.prefix = list(prefix)
+
+    def __call__(self, batch):
+        smiles = [smi for smi, _ in batch]
+        labels = default_collate([lab for _, lab in batch])
+        return tokenize_batch(self.tokenizer, smiles, self.prefix), labels
+
+
+def token_lengths(tokenizer, smiles, prefix=()):
+    ''' number of tokens per SMILES, incl. prefix tokens (eg. <REG>) '''
+    return np.array([len(tokenizer.text_to_tokens(s)) + len(prefix)
+                     for s in smiles], dtype=np.int64)
+
+
+def padding_waste(lengths, batches):
+    ''' fraction of padded tokens when each batch is padded to its longest
+        sequence, and the attention cost (sum of b * n_max^2) '''
+    padded, cost = 0, 0
+    for batch in batches:
+        n_max = int(lengths[batch].max())
+        padded += n_max * len(batch)
+        cost += n_max ** 2 * len(batch)
+    return 1. - lengths.sum() / padded, cost
+
+
+class LengthBucketSampler(Sampler):
+    """ yields indices so that consecutive batch_size chunks hold SMILES of
+        similar token length, reducing padding in tokenize_batch.
+        use with DataLoader(sampler=..., batch_size=batch_size, shuffle=False)
+
+        shuffle=False: sort by length (predict). order holds the dataset
+            index of each yielded sample, restore_order() undoes the sort.
+        shuffle=True: shuffle, sort within buckets of bucket_batches
+            batches, shuffle batch order (train). reshuffled each epoch.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=False,
+                 bucket_batches=50, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_batches
+        self.rng = np.random.default_rng(seed)
+        self.order = self.make_order()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        if self.shuffle:
+            self.order = self.make_order()
+        return iter(self.order.tolist())
+
+    def make_order(self):
+        if not self.shuffle:
+            return np.argsort(self.lengths, kind='stable')
+        idx = self.rng.permutation(len(self.lengths))
+        idx = np.concatenate([
+            bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            for bucket in np.split(idx, range(
+                self.bucket_size, len(idx), self.bucket_size))])
+        batches = self.batches(idx)
+        # keep a partial batch last, batches stay aligned with the loader
+        n_full = len(idx) // self.batch_size
+        perm = self.rng.permutation(n_full).tolist() \
+            + list(range(n_full, len(batches)))
+        return np.concatenate([batches[i] for i in perm])
+
+    def batches(self, order=None):
+        order = self.order if order is None else order
+        return np.split(order, range(
+            self.batch_size, len(order), self.batch_size))
+
+    def restore_order(self, values):
+        ''' values in sampler order (eg. concatenated predictions)
+            to dataset order '''
+        restored = [None] * len(values)
+        for i, value in zip(self.order, values):
+            restored[i] = value
+        return restored
+
+    def report(self, name=''):
+        ''' padding waste & attention cost vs sequential batching '''
+        sequential = self.batches(np.arange(len(self.lengths)))
+        waste, cost = padding_waste(self.lengths, self.batches())
+        seq_waste, seq_cost = padding_waste(self.lengths, sequential)
+        print(f"{name} padding waste: {waste:.3f} bucketed, "
+              f"{seq_waste:.3f} sequential; "
+              f"attention cost x{cost / seq_cost:.2f}")
+        return waste, seq_waste
+
+
+@functools.lru_cache(maxsize=None)
+def morgan_generator(radius=2, nbits=512):
+    ''' one morgan generator per (radius, nbits) and process '''
+    return rdFingerprintGenerator.GetMorganGenerator(radius=radius,
+                                                     fpSize=nbits)
+
+
+def morgan_packed(smiles, radius=2, nbits=512):
+    ''' bit-packed morgan fingerprints [n, ceil(nbits / 8)] uint8,
+        same bits as AllChem.GetMorganFingerprintAsBitVect '''
+    gen = morgan_generator(radius, nbits)
+    bits = np.zeros((len(smiles), nbits), dtype=np.uint8)
+    for i, smi in enumerate(smiles):
+        bits[i] = gen.GetFingerprintAsNumPy(Chem.MolFromSmiles(smi))
+    return np.packbits(bits, axis=-1)
+
+
+def morgan_fingerprints(smiles, radius=2, nbits=512, n_workers=0,
+                        cache=None, chunksize=512):
+    ''' packed fingerprints for a list of SMILES. only SMILES missing from
+        the ECFPCache (cache: directory, or None) are computed, in chunks
+        over n_workers processes (0: serial) '''
+    cache = cache if isinstance(cache, ECFPCache) else ECFPCache(
+        cache, radius, nbits)
+    missing = cache.missing(smiles)
+    if missing and n_workers and len(missing) > chunksize:
+        chunks = [missing[i:i + chunksize]
+                  for i in range(0, len(missing), chunksize)]
+        with ProcessPoolExecutor(n_workers) as pool:
+            packed = list(pool.map(morgan_packed, chunks,
+                                   [radius] * len(chunks),
+                                   [nbits] * len(chunks)))
+        cache.update(missing, np.concatenate(packed))
+    elif missing:
+        cache.update(missing, morgan_packed(missing, radius, nbits))
+    print(f"ecfp r{radius}-{nbits}: {len(missing)} computed, "
+          f"{len(dict.fromkeys(smiles)) - len(missing)} cached")
+    cache.save()
+    return cache.lookup(smiles)
+
+
+def morgan_counts(smiles, radius=2, nbits=512):
+    ''' morgan count fingerprints of a chunk of SMILES as
+        (on-bit indices, counts) per molecule '''
+    gen = morgan_generator(radius, nbits)
+    rows = []
+    for smi in smiles:
+        counts = gen.GetCountFingerprintAsNumPy(Chem.MolFromSmiles(smi))
+        idx = np.flatnonzero(counts)
+        rows.append((idx, counts[idx]))
+    return rows
+
+
+def morgan_environment(mol, gen, nbits):
+    ''' atoms x bits membership csr_matrix [n_atoms, nbits] (0/1): atom a
+        is in on-bit x if any (center, radius) environment setting x
+        reaches it (the atoms DrawMorganBit highlights) '''
+    ao = rdFingerprintGenerator.AdditionalOutput()
+    ao.AllocateBitInfoMap()
+    gen.GetFingerprint(mol, additionalOutput=ao)
+    rows, cols = [], []
+    for bit, envs in ao.GetBitInfoMap().items():
+        atoms = set()
+        for center, radius in envs:
+            atoms.add(center)
+            for b in Chem.FindAtomEnvironmentOfRadiusN(mol, radius, center):
+                bond = mol.GetBondWithIdx(b)
+                atoms.update((bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()))
+        rows.extend(atoms)
+        cols.extend([bit] * len(atoms))
+    return csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                      shape=(mol.GetNumAtoms(), nbits))
+
+
+def morgan_environments(smiles, radius=2, nbits=512):
+    ''' morgan_environment of a chunk of SMILES '''
+    gen = morgan_generator(radius, nbits)
+    return [morgan_environment(Chem.MolFromSmiles(smi), gen, nbits)
+            for smi in smiles]
+
+
+def packed_on_bits(packed, nbits, chunksize=4096):
+    ''' on-bit indices per row of packed fingerprints as a RaggedArray,
+        unpacked chunk-wise so no dense [n, nbits] array is built '''
+    indices, lengths = [], []
+    for start in range(0, len(packed), chunksize):
+        bits = np.unpackbits(packed[start:start + chunksize], axis=-1,
+                             count=nbits)
+        rows, cols = np.nonzero(bits)
+        indices.append(cols)
+        lengths.append(np.bincount(rows, minlength=len(bits)))
+    offsets = np.zeros(len(packed) + 1, dtype=np.int64)
+    if indices:
+        offsets[1:] = np.cumsum(np.concatenate(lengths))
+    values = np.concatenate(indices) if indices else np.zeros(0)
+    return RaggedArray(values.astype(np.int64), offsets)
+
+
+def ecfp_kwargs(cfg):
+    ''' ECFPDataSplit args from the model config '''
+    return dict(nbits=cfg.model.nbits,
+                radius=cfg.model.get('radius', 2),
+                n_workers=cfg.model.get('ecfp_workers', 8),
+                cache_dir=cfg.model.get('ecfp_cache', './data/ecfp'),
+                sparse=cfg.model.get('ecfp_sparse', True),
+                counts=cfg.model.get('ecfp_counts', False))
+
+
+class SparseECFP(NamedTuple):
+    """ fingerprint batch as on-bit index bags, for F.embedding_bag:
+        indices [nnz], offsets [batch] (bag starts), weights [nnz]
+        (counts, None for 0/1 fingerprints) """
+    indices: torch.Tensor
+    offsets: torch.Tensor
+    weights: Optional[torch.Tensor]
+
+
 class ECFPDataSplit(DataSplit):
-    def __init__(self, ds, nbits=512):
+    ''' morgan fingerprints kept bit-packed (nbits / 8 bytes per molecule)
+        and as on-bit indices (on_bits, plus counts with counts=True).
+        sparse=True yields index bags per item, collated to SparseECFP,
+        otherwise float32 rows. cache_dir holds the packed fingerprints of
+        all SMILES seen before, per radius and nbits.
+    '''
+
+    def __init__(self, ds, nbits=512, radius=2, n_workers=0, cache_dir=None,
+                 sparse=False, counts=False, chunksize=512):
         self.smiles = ds.smiles
         self.labels = ds.labels
         self.subset = ds.subset
         self.nbits = nbits
-        self.make_ecfp()
-
-    def make_ecfp(self):
-        # try:
-        #     print([Chem.MolFromSmiles(smi) for smi in self.smiles])
-        # except:
-        #     print(smi)
-        ecfp = [AllChem.GetMorganFingerprintAsBitVect(
-                    Chem.MolFromSmiles(smi), radius=2, nBits=self.nbits
-               ) for smi in self.smiles]
-        self.ecfp = torch.tensor(ecfp, dtype=torch.float32)
+        self.radius = radius
+        self.sparse = sparse
+        self.packed = morgan_fingerprints(list(self.smiles), radius, nbits,
+                                          n_workers, cache_dir, chunksize)
+        self.on_bits = packed_on_bits(self.packed, nbits)
+        self.counts = None
+        self.envs = None
+        if counts:
+            self.counts = self.count_fingerprints(n_workers, chunksize)
+        print(f"ecfp {self.subset}: {self.on_bits.lengths.mean():.1f} "
+              f"on-bits / {nbits} per molecule")
+
+    def map_chunks(self, fn, n_workers=0, chunksize=512):
+        ''' fn(smiles_chunk, radius, nbits) over all SMILES, in a process
+            pool with n_workers, results concatenated '''
+        smiles = list(self.smiles)
+        chunks = [smiles[i:i + chunksize]
+                  for i in range(0, len(smiles), chunksize)]
+        args = ([self.radius] * len(chunks), [self.nbits] * len(chunks))
+        if n_workers and len(chunks) > 1:
+            with ProcessPoolExecutor(n_workers) as pool:
+                done = list(pool.map(fn, chunks, *args))
+        else:
+            done = list(map(fn, chunks, *args))
+        return [row for chunk in done for row in chunk]
+
+    def count_fingerprints(self, n_workers=0, chunksize=512):
+        ''' counts aligned with on_bits (a bit is on iff its count > 0) '''
+        rows = self.map_chunks(morgan_counts, n_workers, chunksize)
+        assert all(np.array_equal(idx, self.on_bits[i])
+                   for i, (idx, _) in enumerate(rows))
+        return RaggedArray.from_rows([cnt for _, cnt in rows],
+                                     dtype=np.float32)
+
+    def environments(self, n_workers=0, chunksize=512):
+        ''' atoms x bits membership matrix per molecule
+            (morgan_environment), computed once '''
+        if self.envs is None:
+            self.envs = self.map_chunks(morgan_environments, n_workers,
+                                        chunksize)
+        return self.envs
+
+    def attribute(self, idx, weights, norm=True):
+        ''' atom attributions [n_atoms] of molecule idx for bit weights
+            [nbits], eg. fc1.weight, svr feature weights or shap values:
+            each on-bit weight is added to the atoms of its environment,
+            split evenly over them with norm=True. one sparse mat-vec,
+            rdkit is not used again after environments()
+        '''
+        env = self.environments()[idx]
+        if norm:
+            env = env.multiply(
+                1. / np.maximum(np.asarray(env.sum(axis=0)), 1.)).tocsr()
+        return env @ np.ravel(weights).astype(np.float64)
+
+    def bits(self, idx=slice(None)):
+        ''' unpacked 0/1 fingerprints uint8 [..., nbits] '''
+        return np.unpackbits(self.packed[idx], axis=-1, count=self.nbits)
+
+    def csr(self, idx=slice(None)):
+        ''' scipy csr_matrix [n, nbits] float32 built from on_bits,
+            eg. for sklearn heads '''
+        data = np.ones(len(self.on_bits.values), dtype=np.float32) \
+            if self.counts is None else self.counts.values
+        matrix = csr_matrix((data, self.on_bits.values, self.on_bits.offsets),
+                            shape=(len(self), self.nbits))
+        return matrix[[idx]] if np.isscalar(idx) else matrix[idx]
+
+    def dense(self, idx=slice(None)):
+        if self.counts is None:
+            return torch.from_numpy(self.bits(idx).astype(np.float32))
+        rows = self.csr(idx).toarray()
+        return torch.from_numpy(rows[0] if np.isscalar(idx) else rows)
+
+    @property
+    def ecfp(self):
+        ''' dense float32 fingerprints [n, nbits] '''
+        return self.dense()
+
+    def __getitem__(self, idx):
+        if self.sparse:
+            data = (self.on_bits[idx],
+                    self.counts[idx] if self.counts is not None else None)
+        else:
+            data = self.dense(idx)
+        labels = self.labels[idx]
+        return data, labels
+
+    def collate(self, batch):
+        ''' DataLoader collate_fn, index bags to SparseECFP '''
+        if not self.sparse:
+            return default_collate(batch)
+        bags = [bag for (bag, _), _ in batch]
+        offsets = np.zeros(len(bags), dtype=np.int64)
+        offsets[1:] = np.cumsum([len(bag) for bag in bags])[:-1]
+        weights = None
+        if self.counts is not None:
+            weights = torch.from_numpy(
+                np.concatenate([cnt for (_, cnt), _ in batch]))
+        labels = default_collate([lab for _, lab in batch])
+        return SparseECFP(
+            indices=torch.from_numpy(np.concatenate(bags)),
+            offsets=torch.from_numpy(offsets),
+            weights=weights), labels
+
+
+class EmbeddingDataSplit(DataSplit):
+    def __init__(self, ds, feats, lengths, pooling='reg'):
+        """ DataSplit over cached (frozen) encoder features
+            pooling='reg': feats are <REG> token embeddings
+            pooling='avg': feats are masked sums over tokens, divided by
+                           the padded batch length in collate, like the
+                           torch.mean in BaselineAqueousModel.forward
+        """
+        self.smiles = ds.smiles
+        self.labels = ds.labels
+        self.subset = ds.subset
+        self.feats = feats
+        self.lengths = lengths
+        self.pooling = pooling
 
     def __getitem__(self, idx):
-        data = self.ecfp[idx]
+        data = (self.feats[idx], self.lengths[idx])
         labels = self.labels[idx]
         return data, labels
 
+    def collate(self, batch):
+        feats = torch.stack([f for (f, _), _ in batch])
+        lengths = torch.stack([ln for (_, ln), _ in batch])
+        labels = default_collate([lab for _, lab in batch])
+        if self.pooling == 'avg':
+            feats = feats / lengths.max()
+        return feats, labels
+
+
+def murcko_scaffold(smi):
+    ''' get murcko-* (generic) scaffold from smi '''
+    mol = Chem.MolFromSmiles(smi)
+    scaffold = MurckoScaffold.GetScaffoldForMol(mol)
+    scaffold = MurckoScaffold.MakeScaffoldGeneric(scaffold)
+    return Chem.MolToSmiles(scaffold, canonical=True)
+
+
+def murcko_scaffolds(smiles, n_workers=0, cache=None, chunksize=512):
+    ''' scaffolds for a list of SMILES. only SMILES missing from the
+        ScaffoldCache (cache: path, or None) are computed, with n_workers
+        processes (0: serial) '''
+    cache = cache if isinstance(cache, ScaffoldCache) else ScaffoldCache(cache)
+    missing = cache.missing(smiles)
+    if missing and n_workers and len(missing) > chunksize:
+        with ProcessPoolExecutor(n_workers) as pool:
+            cache.update(missing, list(
+                pool.map(murcko_scaffold, missing, chunksize=chunksize)))
+    elif missing:
+        cache.update(missing, [murcko_scaffold(smi) for smi in missing])
+    print(f"scaffolds: {len(missing)} computed, "
+          f"{len(dict.fromkeys(smiles)) - len(missing)} cached")
+    cache.save()
+    return cache.lookup(smiles)
+
 
 class MurckoScaffoldSplitter():
     # 10544 798 461 with k=3, seed=42
     # 7287 3590 921 with k=2, seed=42
-    def __init__(self, smiles, n_splits=1, test_size=0.1, seed=42, top_k=2):
+    def __init__(self, smiles, n_splits=1, test_size=0.1, seed=42, top_k=2,
+                 n_workers=0, cache=None):
         self.n_splits = n_splits
         self.test_size = test_size,
         self.seed = seed
         self.top_k = top_k
-        self.topscf = self.get_top_scaffolds(
-            [self.get_murcko_scaffolds(smi) for smi in smiles]
-        )
+        # computed once, split() looks them up again
+        self.scaffolds = dict(zip(
+            smiles, murcko_scaffolds(smiles, n_workers, cache)))
+        self.topscf = set(self.get_top_scaffolds(
+            [self.scaffolds[smi] for smi in smiles]))
 
     def get_murcko_scaffolds(self, smi):
         ''' get murcko-* scaffolds from smi '''
-        mol = Chem.MolFromSmiles(smi)
-        scaffold = MurckoScaffold.GetScaffoldForMol(mol)
-        scaffold = MurckoScaffold.MakeScaffoldGeneric(scaffold)
-        return Chem.MolToSmiles(scaffold, canonical=True)
+        return murcko_scaffold(smi)
 
     def get_top_scaffolds(self, scaffolds):
         ''' get list of most frequent murcko-* scaffolds '''
@@ -234,7 +710,8 @@ class MurckoScaffoldSplitter():
 
     def split(self, smiles):
         ''' split dataset using frequent murcko-* scaffolds '''
-        scaffolds = [self.get_murcko_scaffolds(smi) for smi in smiles]
+        scaffolds = [self.scaffolds[smi] if smi in self.scaffolds
+                     else self.get_murcko_scaffolds(smi) for smi in smiles]
         scaffolds = [s if s in self.topscf else 'rare' for s in scaffolds]
         # print('nunique', np.unique(scaffolds, return_counts=True))
         # splitter = GroupShuffleSplit(n_splits=self.n_splits,
@@ -255,10 +732,10 @@ class MurckoScaffoldSplitter():
 class AqSolDataset(PropertyDataset):
     def __init__(self, subset, file_path, smilesname, propname,
                  split, split_frac, n_splits=5, data_seed=42,
-                 scale=False, augment=False):
+                 scale=False, augment=False, **kwargs):
         super().__init__(subset, file_path, smilesname, propname,
                          split, split_frac, n_splits, data_seed,
-                         scale, augment)
+                         scale, augment, **kwargs)
         # self.smilesname = 'smiles solute'
         # self.propname = 'logS_aq_avg'
 
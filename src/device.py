@@ -0,0 +1,46 @@
+import torch
+
+
+def device_cfg(cfg=None):
+    ''' device group of the params.yaml config, {} if not set '''
+    if cfg is None:
+        return {}
+    return cfg.get('device', None) or {}
+
+
+def use_gpu(cfg=None):
+    ''' gpu if one is available, unless the device config asks for cpu '''
+    accelerator = device_cfg(cfg).get('accelerator', 'auto')
+    return accelerator != 'cpu' and torch.cuda.is_available()
+
+
+def default_device(cfg=None):
+    return torch.device('cuda' if use_gpu(cfg) else 'cpu')
+
+
+def configure_cpu(cfg=None):
+    ''' intra-/inter-op thread counts for cpu nodes, 0 keeps torch defaults '''
+    dev = device_cfg(cfg)
+    num_threads = dev.get('num_threads', 0)
+    num_interop_threads = dev.get('num_interop_threads', 0)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work
+            print('num_interop_threads already set')
+    print(f"cpu threads: {torch.get_num_threads()}, "
+          f"interop: {torch.get_num_interop_threads()}")
+
+
+def trainer_kwargs(cfg=None):
+    ''' pl.Trainer device args: fp16 on gpu, fp32 (or bf16) on cpu '''
+    dev = device_cfg(cfg)
+    if use_gpu(cfg):
+        return dict(accelerator='gpu', gpus=1,
+                    precision=dev.get('gpu_precision', 16))
+    configure_cpu(cfg)
+    return dict(accelerator='cpu',
+                precision=dev.get('cpu_precision', 32))
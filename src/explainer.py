@@ -2,6 +2,8 @@
 
 """ adapted from ref: https://arxiv.org/abs/2103.15679 """
 
+import heapq
+import itertools
 import torch
 from rdkit.Chem import Draw
 from rdkit import Chem
@@ -12,6 +14,8 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import Normalize
 from matplotlib.cm import ScalarMappable
 from omegaconf import OmegaConf
+from src.cache import LRUCache
+from src.render import render_molecule
 
 cfg = OmegaConf.load('./params.yaml')
 basepath = f"./out/{cfg.task.task}/{cfg.split.split}"
@@ -19,19 +23,29 @@ mdir = f"{cfg.model.model}-{cfg.head.head}"
 
 
 class MolecularSelfAttentionViz():
-    """ apply self-attention update rule only """
-
-    def __init__(self, n_layers=6, save_heatmap=False, sign=''):
+    """ apply self-attention update rule only
+
+        propagation:
+            'row':  propagate only the <REG> row of the relevance matrix,
+                    O(n^2) per layer (default)
+            'full': propagate the full [ml, ml] relevance matrix,
+                    O(n^3) per layer. always used with save_heatmap
+    """
+
+    def __init__(self, n_layers=6, save_heatmap=False, sign='',
+                 propagation='row'):
+        assert propagation in ['row', 'full']
         self.n_layers = n_layers
         self.save_heatmap = save_heatmap
         self.sign = sign
+        self.propagation = 'full' if save_heatmap else propagation
         self.uid = 0
 
-    def avg_heads(self, attn, grad):
+    def avg_heads(self, attn, grad, dim=0):
         """ identical, increased readability """
         attn_grad = grad * attn
         attn_grad = attn_grad.clamp(min=0)
-        return attn_grad.mean(dim=0)
+        return attn_grad.mean(dim=dim)
 
         # attn = grad.permute(0, 2, 1) * attn.permute(0, 2, 1)
         # return attn.clamp(min=0).mean(dim=0)
@@ -88,6 +102,47 @@ class MolecularSelfAttentionViz():
             save_heat(torch.eye(ml), ml, token, f'{prefix}_identity')
         return rel
 
+    def agg_relevance_row(self, attn, grad, ml, row=0):
+        """ propagate a single row of the relevance matrix.
+            rel = (I + A_L) ... (I + A_1), so its row is obtained by
+            vector-matrix products from the last layer to the first:
+                r <- r + r A_l,  r_init = e_row
+            returns: [1, ml] row, identical to agg_relevance(...)[row]
+        """
+        rel = torch.zeros(1, ml)
+        rel[0, row] = 1.
+        # cast to float32 for torch.clamp
+        attn, grad = attn.float(), grad.float()
+
+        # loop through each layer, last to first
+        for layer in reversed(range(self.n_layers)):
+            attn_map = self.avg_heads(
+                attn[layer, :, :ml, :ml],
+                grad[layer, :, :ml, :ml]
+            ).cpu().detach()
+
+            # apply update rule to the row only
+            rel = rel + torch.matmul(rel, attn_map)
+        return rel
+
+    def batch_relevance_row(self, attn_maps, masks, row=0):
+        """ batched, padding-aware version of agg_relevance_row.
+            stays on the device of attn_maps.
+            attn_maps: [batch, n_layers, n, n] head-averaged attn x grad
+            masks:     [batch, n] encoder masks
+            returns:   [batch, n] relevance rows, padding is zero
+        """
+        masks = masks.to(attn_maps.device, attn_maps.dtype)
+        # zero padded rows & cols, equivalent to slicing [:ml, :ml]
+        attn_maps = attn_maps * masks[:, None, :, None] \
+            * masks[:, None, None, :]
+
+        rel = torch.zeros_like(masks).unsqueeze(1)
+        rel[:, 0, row] = 1.
+        for layer in reversed(range(self.n_layers)):
+            rel = rel + torch.bmm(rel, attn_maps[:, layer])
+        return rel.squeeze(1)
+
     def get_weights(self, rel, ml):
         """ extract weights from <R> token importance """
         # apply mask and remove I diagonal
@@ -98,9 +153,43 @@ class MolecularSelfAttentionViz():
         # alternatively extract column
         # return np.array(rel[1:, 0])
 
+    def explain_batch(self, attn, grad, masks, tokens=None):
+        """ explain a batch from full per-head captures (attn_capture='full'),
+            molecule by molecule: heatmaps need the full relevance matrix
+            of every single molecule. reduced captures go to explain_maps.
+            attn, grad: [batch, n_layers, n_heads, n, n]
+            masks:      [batch, n]
+            returns: list of <R> token relevance weights per molecule
+        """
+        return [self(attn[i], grad[i], masks[i],
+                     tokens[i] if tokens else None)
+                for i in range(len(masks))]
+
+    def explain_maps(self, attn_maps, masks):
+        """ explain a batch from already head-averaged attn x grad maps,
+            as captured by CoreAttention with attn_capture='reduced'
+            attn_maps: [batch, n_layers, n, n]
+            masks:     [batch, n]
+        """
+        with torch.no_grad():
+            rel = self.batch_relevance_row(attn_maps.float(), masks)
+
+        lengths = masks.sum(dim=1).tolist()
+        rel = rel.cpu().numpy()
+        self.uid += len(lengths)
+        # drop <R> token itself and padding
+        return [rel[i, 1:ml] for i, ml in enumerate(lengths)]
+
     def __call__(self, attn, grad, mask, token=None):
         # get mask length
-        ml = sum(mask)
+        ml = int(sum(mask))
+        if self.propagation == 'row':
+            # aggregate <R> row of relevance matrix R only
+            rel = self.agg_relevance_row(attn, grad, ml)
+            self.uid += 1
+            # drop <R> token itself, identity only touches that column
+            return np.array(rel[0, 1:])
+
         # aggregate relevance matrix R
         rel = self.agg_relevance(attn, grad, ml, token)
         # keep track of uid viz
@@ -109,6 +198,244 @@ class MolecularSelfAttentionViz():
         return self.get_weights(rel, ml)
 
 
+class TokenPartitionShap():
+    """ batched SHAP for token models, a re-implementation of
+        shap.PartitionExplainer (owen values, fixed_context=None) on the
+        partition tree of shap.maskers.Text.
+
+        coalitions of all molecules are built as token id tensors: masked
+        tokens get <MASK> ids and attention mask 0. each round takes up to
+        batch_size coalitions per molecule from its priority queue, as
+        PartitionExplainer does for a single molecule, and evaluates the
+        coalitions of all molecules in padded forward batches of n_forward.
+
+        masked token id sequences are memoized in an LRUCache (cache), so a
+        coalition repeated within or across molecules is encoded once.
+        n_evals counts encoded sequences.
+
+        model.masked_forward(ids, masks, lengths) -> [n] outputs
+        clustering(smi) -> [M-1, 4] linkage, eg. shap.maskers.Text.clustering
+    """
+
+    def __init__(self, model, tokenizer, clustering, max_evals=500,
+                 batch_size=10, n_forward=1024, seed=0, cache=None):
+        self.model = model
+        self.cache = cache if cache is not None else LRUCache()
+        self.tokenizer = tokenizer
+        self.clustering = clustering
+        self.max_evals = max_evals
+        self.batch_size = batch_size
+        self.n_forward = n_forward
+        self.rng = np.random.default_rng(seed)
+        self.counter = itertools.count()
+        self.n_evals = 0
+
+    def evaluate(self, ids, coalitions):
+        """ model outputs for (molecule, coalition) pairs
+            ids: token ids per molecule, coalitions: [(mol, bool mask [M])]
+        """
+        out = np.zeros(len(coalitions))
+        todo = {}
+        for i, (mol, mask) in enumerate(coalitions):
+            key = tuple(np.where(mask, ids[mol], self.tokenizer.mask_id))
+            if key in todo:
+                # repeated within this request, encoded once
+                self.cache.hits += 1
+                todo[key].append(i)
+                continue
+            value = self.cache.get(key)
+            if value is None:
+                todo[key] = [i]
+            else:
+                out[i] = value
+        keys = list(todo)
+        for key, value in zip(keys, self.forward(keys)):
+            self.cache.put(key, value)
+            out[todo[key]] = value
+        return out
+
+    def forward(self, keys):
+        """ masked_forward on masked token id sequences, n_forward at once """
+        outputs = []
+        device = self.model.encoder_device
+        for i in range(0, len(keys), self.n_forward):
+            chunk = keys[i:i+self.n_forward]
+            n = max(len(key) for key in chunk)
+            tokens = np.full((len(chunk), n), self.tokenizer.pad_id)
+            lengths = np.array([len(key) for key in chunk])
+            for row, key in enumerate(chunk):
+                tokens[row, :len(key)] = key
+            masks = (tokens != self.tokenizer.mask_id) \
+                & (np.arange(n) < lengths[:, None])
+            with torch.no_grad():
+                out = self.model.masked_forward(
+                    torch.tensor(tokens, dtype=torch.int64, device=device),
+                    torch.tensor(masks, dtype=torch.int64, device=device),
+                    torch.tensor(lengths, device=device))
+            outputs.append(out.float().cpu().numpy())
+        self.n_evals += len(keys)
+        return np.concatenate(outputs) if outputs else np.zeros(0)
+
+    def push(self, queue, f_diff, args):
+        # largest change first, random tie break as in PartitionExplainer
+        heapq.heappush(queue, (-np.max(np.abs(f_diff)) * args[-1],
+                               self.rng.standard_normal(),
+                               next(self.counter), args))
+
+    def __call__(self, smiles):
+        """ returns per-token shap values [M] for each SMILES """
+        ids = [np.array(self.tokenizer.token_to_ids(
+            self.tokenizer.text_to_tokens(smi))) for smi in smiles]
+        n_mols = len(ids)
+        trees, mask_matrix, dvalues = [], [], []
+        for smi, mol_ids in zip(smiles, ids):
+            M = len(mol_ids)
+            tree = np.array(self.clustering(smi)).reshape(-1, 4)
+            # rows: leaves, then clusters: tokens covered by each node
+            nodes = np.zeros((2 * M - 1, M), dtype=bool)
+            nodes[np.arange(M), np.arange(M)] = True
+            for j, (li, ri) in enumerate(tree[:, :2].astype(int)):
+                nodes[M + j] = nodes[li] | nodes[ri]
+            trees.append(tree)
+            mask_matrix.append(nodes)
+            dvalues.append(np.zeros(2 * M - 1))
+
+        # base value (all masked) and full prediction (none masked)
+        f = self.evaluate(ids, [(m, np.zeros(len(ids[m]), dtype=bool))
+                                for m in range(n_mols)]
+                          + [(m, np.ones(len(ids[m]), dtype=bool))
+                             for m in range(n_mols)])
+        queues = [[] for _ in range(n_mols)]
+        for m in range(n_mols):
+            M = len(ids[m])
+            self.push(queues[m], 0., (np.zeros(M, dtype=bool), f[m],
+                                      f[n_mols + m], 2 * M - 2, 1.0))
+        # shap evaluates base and full prediction outside the budget
+        max_evals = self.max_evals - 2
+        eval_count = np.zeros(n_mols, dtype=int)
+
+        while any(queues):
+            work, coalitions = [], []
+            for m, queue in enumerate(queues):
+                M = len(ids[m])
+                if eval_count[m] >= max_evals:
+                    # budget spent: leave the rest on internal nodes
+                    while queue:
+                        m00, f00, f11, ind, weight = heapq.heappop(queue)[-1]
+                        dvalues[m][ind] += (f11 - f00) * weight
+                    continue
+                n_masks = 0
+                while queue and n_masks < self.batch_size \
+                        and eval_count[m] + n_masks < max_evals:
+                    m00, f00, f11, ind, weight = heapq.heappop(queue)[-1]
+                    if ind < M or trees[m][ind - M, 2] < 0:
+                        # leaf
+                        dvalues[m][ind] += (f11 - f00) * weight
+                        continue
+                    lind, rind = trees[m][ind - M, :2].astype(int)
+                    m10 = m00 | mask_matrix[m][lind]
+                    m01 = m00 | mask_matrix[m][rind]
+                    work.append((m, m00, m10, m01, f00, f11, lind, rind,
+                                 weight))
+                    coalitions += [(m, m10), (m, m01)]
+                    n_masks += 2
+                eval_count[m] += n_masks
+            if not coalitions:
+                continue
+            fout = self.evaluate(ids, coalitions)
+            for i, (m, m00, m10, m01, f00, f11, lind, rind,
+                    weight) in enumerate(work):
+                f10, f01 = fout[2 * i], fout[2 * i + 1]
+                weight = weight / 2
+                self.push(queues[m], f10 - f00, (m00, f00, f10, lind, weight))
+                self.push(queues[m], f01 - f00, (m00, f00, f01, rind, weight))
+                self.push(queues[m], f11 - f01, (m01, f01, f11, lind, weight))
+                self.push(queues[m], f11 - f10, (m10, f10, f11, rind, weight))
+
+        return [self.lower_credit(dvalues[m], trees[m], len(ids[m]))
+                for m in range(n_mols)]
+
+    @staticmethod
+    def lower_credit(dvalues, tree, M):
+        """ push credit left on internal nodes down to the tokens,
+            split by cluster size """
+        values = dvalues.copy()
+        stack = [(2 * M - 2, 0.)]
+        while stack:
+            i, value = stack.pop()
+            values[i] += value
+            if i < M:
+                continue
+            li, ri = tree[i - M, :2].astype(int)
+            size = tree[i - M, 3]
+            lsize = tree[li - M, 3] if li >= M else 1
+            rsize = tree[ri - M, 3] if ri >= M else 1
+            stack.append((li, values[i] * lsize / size))
+            stack.append((ri, values[i] * rsize / size))
+        return values[:M]
+
+
+class ExactTokenShap(TokenPartitionShap):
+    """ exact token Shapley values from all 2^M coalitions, for short
+        SMILES. coalitions of all molecules are evaluated in padded
+        forward batches of n_forward, see TokenPartitionShap.evaluate
+    """
+
+    def __init__(self, model, tokenizer, n_forward=1024, cache=None):
+        super().__init__(model, tokenizer, clustering=None,
+                         n_forward=n_forward, cache=cache)
+
+    @staticmethod
+    def coalitions(M):
+        """ all 2^M masks [2^M, M], row k has token i iff bit i of k """
+        return (np.arange(2 ** M)[:, None] >> np.arange(M)) & 1 == 1
+
+    @staticmethod
+    def shapley(f, M):
+        """ phi_i = sum_S |S|!(M-|S|-1)!/M! (f(S+i) - f(S)), f over
+            coalitions(M) """
+        k = np.arange(2 ** M)
+        size = ExactTokenShap.coalitions(M).sum(axis=1)
+        fact = np.cumprod([1.] + list(range(1, M + 1)))
+        weight = fact[size] * fact[np.maximum(M - size - 1, 0)] / fact[M]
+        phi = np.zeros(M)
+        for i in range(M):
+            without = k[(k >> i) & 1 == 0]
+            phi[i] = np.sum(weight[without] * (f[without | (1 << i)]
+                                               - f[without]))
+        return phi
+
+    def __call__(self, smiles):
+        """ returns exact per-token shap values [M] for each SMILES """
+        ids = [np.array(self.tokenizer.token_to_ids(
+            self.tokenizer.text_to_tokens(smi))) for smi in smiles]
+        coalitions, offsets = [], [0]
+        for m, mol_ids in enumerate(ids):
+            coalitions += [(m, mask) for mask in self.coalitions(len(mol_ids))]
+            offsets.append(len(coalitions))
+        f = self.evaluate(ids, coalitions)
+        values = []
+        for m in range(len(ids)):
+            f_m = f[offsets[m]:offsets[m+1]]
+            phi = self.shapley(f_m, len(ids[m]))
+            # efficiency: values sum to f(all) - f(none)
+            assert np.isclose(phi.sum(), f_m[-1] - f_m[0],
+                              atol=1e-6 * max(np.abs(f_m).max(), 1.))
+            values.append(phi)
+        return values
+
+
+def cmap_from_name(name):
+    ''' xai.cmap setting to a colormap, None for the ColorMapper default '''
+    if name == 'div':
+        return sns.color_palette("coolwarm", as_cmap=True)
+    elif name == 'Reds':
+        return sns.color_palette("Reds", as_cmap=True)
+    elif name == 'red':
+        return sns.light_palette("red", as_cmap=True)
+    return None
+
+
 class ColorMapper():
     def __init__(self, color='green', diverging=False, cmap=None):
         self.color = color
@@ -134,9 +461,29 @@ class ColorMapper():
         else:
             self.cmap = sns.light_palette(color, reverse=False, as_cmap=True)
 
+        self.atom_set = frozenset(self.atoms)
+        # colour lookup table, cmap(w) == lut[lut_index(w)]
+        self.lut = np.asarray(self.cmap(np.arange(self.cmap.N)))
+        self.vocab, self.vocab_mask = None, None
+
     def filter_atoms(self, weight, token):
         ''' filter out non-atom tokens '''
-        return [weight[i] for i, t in enumerate(token) if t in self.atoms]
+        return [weight[i] for i, t in enumerate(token) if t in self.atom_set]
+
+    def atom_mask(self, vocab):
+        ''' bool [vocab_size], True for atom token ids of a tokenizer vocab '''
+        if self.vocab is not vocab:
+            mask = np.zeros(max(vocab.values()) + 1, dtype=bool)
+            for t, i in vocab.items():
+                mask[i] = t in self.atom_set
+            self.vocab, self.vocab_mask = vocab, mask
+        return self.vocab_mask
+
+    def lut_index(self, weights):
+        ''' matplotlib's quantisation of [0, 1] weights into cmap.N colours,
+            out of range weights get the end colours (under/over default) '''
+        idx = (np.asarray(weights, dtype=np.float64) * self.cmap.N).astype(int)
+        return np.clip(idx, 0, self.cmap.N - 1)
 
     def div_norm(self, weights):
         # normalize into [-1, 1] range, then shift to [0,1]
@@ -169,7 +516,47 @@ class ColorMapper():
 
     def to_rdkit_cmap(self, weight):
         '''helper to map to shape required by RDkit to visualize '''
-        return {i: [tuple(self.cmap(w))] for i, w in enumerate(weight)}
+        rgba = self.lut[self.lut_index(weight)].tolist()
+        return {i: [tuple(c)] for i, c in enumerate(rgba)}
+
+    def batch(self, weights, ids, tokens, vocab, unk_id=1):
+        ''' __call__ + to_rdkit_cmap for a whole batch with array ops.
+            weights: [batch, n] padded array or list of per-token weights
+            ids:     [batch, >= n] token ids aligned with weights
+            tokens:  token strings, their lengths mask the padding. rows
+                     with unknown ids fall back to the token strings.
+            returns: atom_weights, rdkit_colors (lists per molecule)
+        '''
+        lengths = np.array([len(t) for t in tokens])
+        n = int(lengths.max()) if len(lengths) else 0
+        w = np.zeros((len(tokens), n))
+        for i, row in enumerate(weights):
+            w[i, :lengths[i]] = np.asarray(row)[:lengths[i]]
+        ids = np.asarray(ids)[:, :n]
+        valid = np.arange(n) < lengths[:, None]
+        atom = self.atom_mask(vocab)[ids] & valid
+        for i in np.flatnonzero(((ids == unk_id) & valid).any(axis=1)):
+            atom[i, :lengths[i]] = [t in self.atom_set for t in tokens[i]]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.diverging:
+                amax = np.where(atom, np.abs(w), 0.).max(axis=1, initial=0.)
+                amax = np.where(np.round(amax, 0) == 0, 1., amax)
+                w = ((w + 1e-16) * (1 / amax[:, None])) * 0.5 + 0.5
+                assert np.all(w[atom] <= 1.01) and np.all(w[atom] >= -0.01)
+            else:
+                vmin = np.where(atom, w, np.inf).min(axis=1, initial=np.inf)
+                vmax = np.where(atom, w, -np.inf).max(axis=1,
+                                                      initial=-np.inf)
+                span = (vmax - vmin)[:, None]
+                w = np.where(span > 0, (w - vmin[:, None]) / span, 0.)
+
+        rgba = self.lut[self.lut_index(w)]
+        atom_weights = [w[i][atom[i]] for i in range(len(tokens))]
+        rdkit_colors = [{j: [tuple(c)] for j, c in
+                         enumerate(rgba[i][atom[i]].tolist())}
+                        for i in range(len(tokens))]
+        return atom_weights, rdkit_colors
 
 
 def make_legend(colormap=None, orientation='vertical'):
@@ -300,31 +687,9 @@ def plot_rel_layers(all_rel, ml, token, prefix=''):
     plt.clf()
 
 def plot_weighted_molecule(atom_colors, smiles, token, label, pred, prefix="", savedir=""):
-    atom_colors = atom_colors
-    bond_colors = {}
-    h_rads = {}  # ?
-    h_lw_mult = {}  # ?
-
     # label = f'Experimental: {label:.2f}, predicted: {pred:.2f}\n{smiles}'
-    label = ''
-
-    mol = Chem.MolFromSmiles(smiles)
-    mol = Draw.PrepareMolForDrawing(mol)
-    d = Draw.rdMolDraw2D.MolDraw2DCairo(700, 700)
-    d.drawOptions().padding = 0.0
-
-    mismatch = int(mol.GetNumAtoms()) - len(atom_colors.keys())
-    if mismatch != 0:
-        d.DrawMolecule(mol)
-    else:
-        d.DrawMoleculeWithHighlights(
-            mol, label, atom_colors, bond_colors, h_rads, h_lw_mult, -1
-        )
-
-    d.FinishDrawing()
-
-    with open(file=f'{savedir}/{prefix}_MolViz.png', mode='wb') as f:
-        f.write(d.GetDrawingText())
+    # single molecule in this process, see MoleculeRenderer for batches
+    render_molecule(smiles, atom_colors, f'{savedir}/{prefix}_MolViz.png')
 
     # some plotting issues for 'C@@H' and 'C@H' tokens since
     # another H atom is rendered explicitly.
@@ -9,6 +9,9 @@ from typing import List
 from nemo_src.regex_tokenizer import RegExTokenizer
 from nemo_src.infer import NeMoMegaMolBARTWrapper
 from src.explainer import ColorMapper, MolecularSelfAttentionViz
+from src.cache import hash_bytes, hash_tokenizer, hash_state_dict
+from src.dataloader import (
+    TokenizedBatch, SmilesCollator, SparseECFP, tokenize_batch, pad_batch)
 from src.maskedhead import (
     MaskedRegressionHead, MaskedLinearRegressionHead)
 from sklearn.ensemble import RandomForestRegressor
@@ -31,49 +34,37 @@ class REGRegExTokenizer(RegExTokenizer):
     def reg_id(self):
         return 6
 
-    def tokenize(self, smis: List[str]):
-        tokens = [self.text_to_tokens(s) for s in smis]
+    def tokenize(self, smis: List[str], device=None):
+        """ ids, masks on device, cpu tensors if device is None (callers
+            pass their encoder device) """
         # Prepend <REG> token
-        token_ids = [self.token_to_ids(['<REG>']+t) for t in tokens]
-        pad_length = max([len(seq) for seq in token_ids])
-
-        encoder_masks = [
-            ([1] * len(seq)) + ([0] * (pad_length - len(seq)))
-            for seq in token_ids
-        ]
-        token_ids = [
-            seq + ([self.pad_id] * (pad_length - len(seq)))
-            for seq in token_ids
-        ]
-
-        token_ids = torch.tensor(token_ids, dtype=torch.int64).cuda()
-        encoder_masks = torch.tensor(encoder_masks,
-                                     dtype=torch.int64,
-                                     device=token_ids.device)
-
-        return token_ids, encoder_masks
-
-    def tokenize_pair(self, solu_smi: List[str], solv_smi: List[str]):
+        batch = tokenize_batch(self, smis, prefix=[self.reg_token])
+        if device is None:
+            return batch.ids, batch.masks
+        return batch.ids.to(device), batch.masks.to(device)
+
+    def tokenize_pair_batch(self, solu_smi: List[str], solv_smi: List[str]):
+        """ tokenize solute/solvent pairs once.
+            ids: <REG> solu <SEP> solv, tokens: solu . solv (rdkit plotting)
+        """
         solu_t = [self.text_to_tokens(s) for s in solu_smi]
         solv_t = [self.text_to_tokens(s) for s in solv_smi]
 
         # Prepend <REG> token, add <SEP> token between solu and solv
         token_ids = [self.token_to_ids(
-            ['<REG>'] + solu + ['<SEP>'] + solv
+            [self.reg_token] + solu + [self.sep_token] + solv
         ) for solu, solv in zip(solu_t, solv_t)]
+        tokens = [solu + ['.'] + solv for solu, solv in zip(solu_t, solv_t)]
+        smiles = [f"{solu}.{solv}" for solu, solv in zip(solu_smi, solv_smi)]
 
-        pad_length = max([len(seq) for seq in token_ids])
-        encoder_masks = [([1] * len(seq)) + ([0] * (pad_length - len(seq)))
-                         for seq in token_ids]
-        token_ids = [seq + ([self.pad_id] * (pad_length - len(seq)))
-                     for seq in token_ids]
-
-        token_ids = torch.tensor(token_ids, dtype=torch.int64).cuda()
-        encoder_masks = torch.tensor(encoder_masks,
-                                     dtype=torch.int64,
-                                     device=token_ids.device)
+        return pad_batch(smiles, tokens, token_ids, self.pad_id)
 
-        return token_ids, encoder_masks
+    def tokenize_pair(self, solu_smi: List[str], solv_smi: List[str],
+                      device=None):
+        batch = self.tokenize_pair_batch(solu_smi, solv_smi)
+        if device is None:
+            return batch.ids, batch.masks
+        return batch.ids.to(device), batch.masks.to(device)
 
 
 class RegressionHead(pl.LightningModule):
@@ -109,6 +100,9 @@ class LinearRegressionHead(pl.LightningModule):
 
 
 class AqueousRegModel(pl.LightningModule):
+    # prepended to each tokenized SMILES
+    token_prefix = ['<REG>']
+
     def __init__(self, head, finetune):
         super().__init__()
         self.finetune = finetune
@@ -119,6 +113,9 @@ class AqueousRegModel(pl.LightningModule):
         print(self.head, head)
         self.explainer = MolecularSelfAttentionViz(sign='agg')
         self.cmapper = ColorMapper()
+        # predict_step: explain (backward + attribution) or predict only
+        self.explain = True
+        self.return_embeddings = False
 
         self.criterion = nn.HuberLoss()
         self.criterion_mse = nn.MSELoss()
@@ -150,6 +147,8 @@ class AqueousRegModel(pl.LightningModule):
             self.mmb.unfreeze()
         else:
             self.mmb.freeze()
+        # capture attention only when explaining, see predict_step
+        self.set_attn_capture(None)
 
     def configure_optimizers(self):
         return optim.AdamW(self.parameters(),
@@ -162,16 +161,81 @@ class AqueousRegModel(pl.LightningModule):
             use <REG> token to aggregate into static shape
             apply regression head to obtain logS
         """
-        # tokenize smiles string of solute
-        solu, mask = self.tokenizer.tokenize(solu_smi)
+        # apply regression head and return logS prediction
+        return self.head(self.embed(solu_smi))
+
+    @property
+    def encoder_device(self):
+        """ device of the MegaMolBART weights, inputs follow it """
+        return next(self.mmb.parameters()).device
+
+    def as_batch(self, inputs):
+        """ TokenizedBatch from the collate_fn, or tokenize SMILES here """
+        if isinstance(inputs, TokenizedBatch):
+            return inputs
+        return tokenize_batch(self.tokenizer, inputs, self.token_prefix)
+
+    def collator(self):
+        """ DataLoader collate_fn tokenizing each batch once """
+        return SmilesCollator(self.tokenizer, self.token_prefix)
+
+    def embed(self, solu_smi):
+        """ <REG> token embedding, input of the regression head """
+        # tokenize smiles string of solute (once per batch)
+        batch = self.as_batch(solu_smi)
+        solu = batch.ids.to(self.encoder_device)
+        mask = batch.masks.to(self.encoder_device)
         # encode with MMB
         solu = self.mmb.encode(solu, mask)
         # apply mask
         solu = solu * mask.unsqueeze(-1)
         # take only the <REG> token
-        solu = solu[:, 0]
-        # apply regression head and return logS prediction
-        return self.head(solu)
+        return solu[:, 0]
+
+    def encode_features(self, smis):
+        """ features to cache for a frozen encoder, see EmbeddingDataSplit
+            returns: <REG> embeddings [b, 512], token lengths [b]
+        """
+        batch = self.as_batch(smis)
+        return self.embed(batch), batch.masks.sum(dim=1)
+
+    def feature_key(self):
+        """ cache key: model class, tokenizer and frozen encoder weights """
+        return hash_bytes(type(self).__name__,
+                          hash_tokenizer(self.tokenizer),
+                          hash_state_dict(self.mmb.state_dict()))
+
+    def attribution_key(self, *settings):
+        """ cache key for attributions: encoder, head and explainer settings
+        """
+        return hash_bytes(self.feature_key(),
+                          type(self.head).__name__,
+                          str(getattr(self.head, 'sign', '')),
+                          hash_state_dict(self.head.state_dict()),
+                          *[str(s) for s in settings])
+
+    def fill_feature_cache(self, cache, smiles, n_batch=64):
+        """ encode each uncached SMILES once and persist the cache """
+        missing = cache.missing(smiles)
+        print(f"encoding {len(missing)} SMILES for feature cache")
+        if not missing:
+            return cache
+        self.mmb.freeze()
+        self.set_attn_capture(None)
+        feats, lengths = [], []
+        device = self.encoder_device
+        with torch.no_grad():
+            for i in range(0, len(missing), n_batch):
+                # match the mixed precision of Trainer(precision=16) on gpu
+                with torch.autocast(device_type=device.type,
+                                    dtype=torch.float16,
+                                    enabled=device.type == 'cuda'):
+                    f, ln = self.encode_features(missing[i:i+n_batch])
+                feats.append(f.float().cpu())
+                lengths.append(ln.cpu())
+        cache.update(missing, torch.cat(feats), torch.cat(lengths))
+        cache.save()
+        return cache
 
     def training_step(self, batch, batch_idx):
         if not self.finetune:
@@ -190,12 +254,25 @@ class AqueousRegModel(pl.LightningModule):
         self.log_dict(metrics)
         return metrics
 
+    def eval_mode(self):
+        """ no attention capture for gradient-free forward passes """
+        self.set_attn_capture(None)
+        if not self.finetune:
+            # unfreeze() was called here before, which also switched the
+            # frozen encoder to train mode. keep the mode, keep the metrics
+            self.mmb.train()
+
+    def evaluate(self, inputs):
+        """ gradient-free forward for validation & test:
+            no autograd graph and no attention capture.
+        """
+        self.eval_mode()
+        with torch.no_grad():
+            return self(inputs)
+
     def validation_step(self, batch, batch_idx):
         inputs, labels = batch
-        if not self.finetune:
-            self.mmb.unfreeze()
-        with torch.set_grad_enabled(True):
-            outputs = self(inputs)
+        outputs = self.evaluate(inputs)
         val_loss = self.criterion(outputs, labels)
         val_mae = self.criterion_mae(outputs, labels)
         val_mse = self.criterion_mse(outputs, labels)
@@ -210,10 +287,7 @@ class AqueousRegModel(pl.LightningModule):
 
     def test_step(self, batch, batch_idx):
         inputs, labels = batch
-        if not self.finetune:
-            self.mmb.unfreeze()
-        with torch.set_grad_enabled(True):
-            outputs = self(inputs)
+        outputs = self.evaluate(inputs)
         test_mae = self.criterion_mae(outputs, labels)
         test_mse = self.criterion_mse(outputs, labels)
         metrics = {
@@ -224,6 +298,23 @@ class AqueousRegModel(pl.LightningModule):
         self.log_dict(metrics)
         return metrics
 
+    def predict_only(self, batch):
+        """ predict without backward pass or attribution,
+            optionally return the head inputs as embeddings
+        """
+        inputs, labels = batch
+        inputs = self.as_batch(inputs)
+        self.set_attn_capture(None)
+        with torch.no_grad():
+            embeddings = self.embed(inputs)
+            preds = self.head(embeddings)
+
+        outputs = {"preds": preds, "labels": labels,
+                   "smiles": inputs.smiles, "tokens": inputs.tokens}
+        if self.return_embeddings:
+            outputs["embeddings"] = embeddings
+        return outputs
+
     def predict_step(self, batch, batch_idx):
         """ predict & explain:
             forward with grad enabled to evaluate attn weights and gradients
@@ -231,34 +322,60 @@ class AqueousRegModel(pl.LightningModule):
             call explainer: propagate relevance, extract <REG> token weights
             call color mapper: map atom-token weights to colors for rdkit plot
         """
+        if not self.explain:
+            # encoder mode as in evaluate and the explain path below
+            self.eval_mode()
+            return self.predict_only(batch)
         inputs, labels = batch
+        # tokenize once: ids/masks for forward & explainer, tokens for cmapper
+        inputs = self.as_batch(inputs)
+        tokens, masks = inputs.tokens, inputs.masks.to(self.encoder_device)
         if not self.finetune:
             self.mmb.unfreeze()
+        self.set_attn_capture(self.explain_capture())
         with torch.set_grad_enabled(True):
             self.zero_grad()
             preds = self(inputs)
         preds.backward(torch.ones_like(preds))
 
-        attn, attn_grads = self.collect_attn_grads()
-
-        # re-construct tokens and masks
-        _, masks = self.tokenizer.tokenize(inputs)
-        tokens = [self.tokenizer.text_to_tokens(s) for s in inputs]
-
         # extract weights & map colors for all samples in batch:
-        rel_weights = [self.explainer(attn[i], attn_grads[i], masks[i], tokens[i])
-                       for i in range(len(inputs))]
-        atom_weights = [self.cmapper(rel_weights[i], tokens[i])
-                        for i in range(len(inputs))]
-        rdkit_colors = [self.cmapper.to_rdkit_cmap(atom_weights[i])
-                        for i in range(len(inputs))]
+        rel_weights = self.explain_captured(masks, tokens)
+        # ids without the <REG> prefix line up with the token weights
+        atom_weights, rdkit_colors = self.cmapper.batch(
+            rel_weights, inputs.ids[:, len(self.token_prefix):].cpu().numpy(),
+            tokens, self.tokenizer.vocab, self.tokenizer.unk_id)
 
         return {"preds": preds, "labels": labels,
-                "smiles": inputs, "tokens": tokens, "masks": masks,
+                "smiles": inputs.smiles, "tokens": tokens, "masks": masks,
                 "rel_weights": rel_weights, "atom_weights": atom_weights,
                 "rdkit_colors": rdkit_colors,
                 }
 
+    def core_attention(self):
+        """ CoreAttention modules of all encoder layers """
+        layers = self.mmb.enc_dec_model.enc_dec_model.encoder.model.layers
+        return [m.self_attention.core_attention for m in layers]
+
+    def set_attn_capture(self, mode):
+        """ set what CoreAttention keeps during forward/backward:
+            'full' (attn + grads per head), 'reduced' (head-averaged
+            clamped attn x grad only) or None (nothing) """
+        for m in self.core_attention():
+            m.attn_capture = mode
+
+    def explain_capture(self):
+        """ heatmaps need every head, row propagation only the reduced map """
+        return 'full' if self.explainer.propagation == 'full' else 'reduced'
+
+    def explain_captured(self, masks, tokens=None):
+        """ run the explainer on what the last backward pass captured """
+        if self.explain_capture() == 'full':
+            attn, attn_grads = self.collect_attn_grads()
+            return self.explainer.explain_batch(
+                attn, attn_grads, masks, tokens)
+        return self.explainer.explain_maps(
+            self.collect_attn_relevance(), masks)
+
     def collect_attn_grads(self):
         """ collect attention activations (attn) and gradients (attn_grads)
             for each layer.
@@ -266,20 +383,23 @@ class AqueousRegModel(pl.LightningModule):
                 [batch, n_layers (6), n_heads (8), len_solu_tok, len_solu_tok]
         """
         attn, attn_grads = [], []
-        for i in range(6):  # self.mmb.num_heads
-            m = self.mmb.enc_dec_model.enc_dec_model.encoder.model.layers[i]
-            attn.append(
-                m.self_attention.core_attention.get_attn()
-            )
-            attn_grads.append(
-                m.self_attention.core_attention.get_attn_gradients()
-            )
+        for m in self.core_attention():
+            attn.append(m.get_attn())
+            attn_grads.append(m.get_attn_gradients())
 
         attn = torch.stack(attn, axis=1)
         attn_grads = torch.stack(attn_grads, axis=1)
 
         return attn, attn_grads
 
+    def collect_attn_relevance(self):
+        """ collect reduced attn x grad maps for each layer.
+            returns: attn_maps of shape
+                [batch, n_layers (6), len_solu_tok, len_solu_tok]
+        """
+        return torch.stack(
+            [m.get_attn_relevance() for m in self.core_attention()], axis=1)
+
 
 class CombiRegModel(AqueousRegModel):
     def __init__(self):
@@ -287,10 +407,13 @@ class CombiRegModel(AqueousRegModel):
         self.head.fc1 = nn.Linear(512+1, 64)
         self.head.norm = nn.LayerNorm(normalized_shape=[512+1])
 
-    def forward(self, inputs):
+    def forward(self, inputs, pair_batch=None):
         solu_smi, solv_smi, temperature = inputs
 
-        tokens, mask = self.tokenizer.tokenize_pair(solu_smi, solv_smi)
+        if pair_batch is None:
+            pair_batch = self.tokenizer.tokenize_pair_batch(solu_smi, solv_smi)
+        tokens = pair_batch.ids.to(self.encoder_device)
+        mask = pair_batch.masks.to(self.encoder_device)
         pair = self.mmb.encode(tokens, mask)
         pair = pair * mask.unsqueeze(-1)
 
@@ -307,29 +430,23 @@ class CombiRegModel(AqueousRegModel):
             call color mapper: map atom-token weights to colors for rdkit plot
         """
         inputs, labels = batch
+        solu_smi, solv_smi, temperature = inputs
+        # tokenize once; tokens drop <REG>, '.' replaces <SEP> for rdkit
+        pair_batch = self.tokenizer.tokenize_pair_batch(solu_smi, solv_smi)
+        tokens = pair_batch.tokens
+        masks = pair_batch.masks.to(self.encoder_device)
+        self.set_attn_capture(self.explain_capture())
         with torch.set_grad_enabled(True):
             self.zero_grad()
-            preds = self(inputs)
+            preds = self(inputs, pair_batch)
         preds.backward(torch.ones_like(preds))
 
-        # reconstruct tokens & mask
-        solu_smi, solv_smi, temperature = inputs
-        solu_t = [self.tokenizer.text_to_tokens(s) for s in solu_smi]
-        solv_t = [self.tokenizer.text_to_tokens(s) for s in solv_smi]
-
-        # drop <REG> token, replace <SEP> with '.' for rdkit plotting
-        tokens = [solu + ['.'] + solv for solu, solv in zip(solu_t, solv_t)]
-        _, masks = self.tokenizer.tokenize_pair(solu_smi, solv_smi)
-
-        attn, attn_grads = self.collect_attn_grads()
-
         # extract weights & map colors for all samples in batch:
-        rel_weights = [self.explainer(attn[i], attn_grads[i], masks[i])
-                       for i in range(len(solu_smi))]
-        atom_weights = [self.cmapper(rel_weights[i], tokens[i])
-                        for i in range(len(solu_smi))]
-        rdkit_colors = [self.cmapper.to_rdkit_cmap(atom_weights[i])
-                        for i in range(len(solu_smi))]
+        rel_weights = self.explain_captured(masks)
+        # drop <REG>, the <SEP> id lines up with the '.' token
+        atom_weights, rdkit_colors = self.cmapper.batch(
+            rel_weights, pair_batch.ids[:, 1:].cpu().numpy(), tokens,
+            self.tokenizer.vocab, self.tokenizer.unk_id)
 
         return {"preds": preds, "labels": labels, "tokens": tokens,
                 "solu_smi": solu_smi, "solv_smi": solv_smi, "masks": masks,
@@ -367,9 +484,52 @@ class ECFPLinear(pl.LightningModule):
             use <REG> token to aggregate into static shape
             apply regression head to obtain logS
         """
+        if isinstance(ecfp, SparseECFP):
+            return self.forward_sparse(ecfp)
         # apply regression head and return logS prediction
         return self.head(ecfp)
 
+    def forward_sparse(self, bags: SparseECFP):
+        """ head on on-bit index bags, same result as on the dense
+            fingerprint x. norm + fc1 reduce to gather-sums over the on-bits:
+            fc1(norm(x)) = (sum_on W*g x - mu sum W*g) / sigma + W b + bias
+            with mu, sigma of x from sum x and sum x^2 (g, b: norm affine)
+        """
+        norm, fc1 = self.head.norm, self.head.fc1
+        device = bags.indices.device
+        w = bags.weights
+        # autocast off: sums and moments in float64 (sum x^2 - (sum x)^2/n
+        # cancels in fp16/fp32), the gather in float32
+        with torch.autocast(device_type=device.type, enabled=False):
+            ones = torch.ones(self.dim, 1, device=device, dtype=torch.float64)
+            s1 = F.embedding_bag(bags.indices, ones, bags.offsets, mode='sum',
+                                 per_sample_weights=None if w is None
+                                 else w.double())
+            if w is None:
+                # 0/1 fingerprint: sum x^2 = sum x
+                var = s1 * (self.dim - s1) / self.dim ** 2
+            else:
+                s2 = F.embedding_bag(bags.indices, ones, bags.offsets,
+                                     mode='sum',
+                                     per_sample_weights=w.double() ** 2)
+                var = (s2 - s1 * s1 / self.dim) / self.dim
+            mu = s1 / self.dim
+            sigma = torch.sqrt(var.clamp(min=0) + norm.eps)
+
+            wg = fc1.weight.float() * norm.weight.float()      # [out, dim]
+            gathered = F.embedding_bag(bags.indices, wg.t(), bags.offsets,
+                                       mode='sum', per_sample_weights=None
+                                       if w is None else w.float())
+            x = (gathered - (mu * wg.sum(1)).float()) / sigma.float() \
+                + fc1.weight.float() @ norm.bias.float()
+            if fc1.bias is not None:
+                x = x + fc1.bias.float()
+        if isinstance(self.head, RegressionHead):
+            x = F.relu(x)
+            x = F.relu(self.head.fc2(x))
+            x = self.head.fc3(x)
+        return x.squeeze(1)
+
     def training_step(self, batch, batch_idx):
         inputs, labels = batch
         outputs = self(inputs)
@@ -424,17 +584,49 @@ class ECFPLinear(pl.LightningModule):
                 layer.reset_parameters()
 
 
+class EmbeddingRegModel(ECFPLinear):
+    heads = ['lin', 'hier']
+
+    def __init__(self, head='lin', dim=512):
+        """ regression head on cached features of a frozen MegaMolBART.
+            head state_dict is interchangeable with AqueousRegModel.head
+            and BaselineAqueousModel.head """
+        if head not in self.heads:
+            raise NotImplementedError(f"no cached-feature head {head}")
+        super().__init__(head=head, dim=dim)
+
+    def validation_step(self, batch, batch_idx):
+        # rmse as logged by AqueousRegModel, same metrics.json keys
+        metrics = super().validation_step(batch, batch_idx)
+        metrics['val_rmse'] = torch.sqrt(metrics['val_mse'])
+        self.log('val_rmse', metrics['val_rmse'])
+        return metrics
+
+    def test_step(self, batch, batch_idx):
+        metrics = super().test_step(batch, batch_idx)
+        metrics['test_rmse'] = torch.sqrt(metrics['test_mse'])
+        self.log('test_rmse', metrics['test_rmse'])
+        return metrics
+
+
 ##########################################
 class BaselineAqueousModel(AqueousRegModel):
-    def __init__(self, head, finetune=False):
-        """ uses average pooling instead of <R> token """
+    # average pooling, no <REG> token
+    token_prefix = []
+
+    def __init__(self, head, finetune=False, device=None):
+        """ uses average pooling instead of <R> token.
+            device: from the device config (default_device(cfg)),
+            None keeps the encoder where it was loaded, the head follows
+        """
         super().__init__(head=head, finetune=finetune)
         self.finetune = finetune
         self.init_molbart()
 
         self.make_head(head)
-        self.head.cuda()
-        self.mmb.cuda()
+        device = device or self.encoder_device
+        self.head.to(device)
+        self.mmb.to(device)
         self.cmapper = ColorMapper()
 
         self.criterion = nn.HuberLoss()
@@ -456,6 +648,7 @@ class BaselineAqueousModel(AqueousRegModel):
             self.mmb.unfreeze()
         else:
             self.mmb.freeze()
+        self.set_attn_capture(None)
 
     # def save_salience(self, grad):
     #     self.salience = torch.pow(grad, 2)
@@ -473,6 +666,10 @@ class BaselineAqueousModel(AqueousRegModel):
 
     def forward(self, inputs):
         # print("in:", inputs)
+        return self.head(self.embed(inputs))
+
+    def embed(self, inputs):
+        """ mean over the padded sequence, input of the regression head """
         solu, mask = self._tokenize(inputs)
         solu = self.mmb.encode(solu, mask)
 
@@ -481,46 +678,35 @@ class BaselineAqueousModel(AqueousRegModel):
 
         solu = solu * mask.unsqueeze(-1)
         solu = torch.mean(solu, dim=1)
-        solu = solu.to(torch.float32)
-        return self.head(solu)
+        return solu.to(torch.float32)
 
-    def _tokenize(self, smis: List[str]):
-        tokens = [self.tokenizer.text_to_tokens(s) for s in smis]
-        token_ids = [self.tokenizer.token_to_ids(t) for t in tokens]
-
-        pad_length = max([len(seq) for seq in token_ids])
-        encoder_mask = [([1] * len(seq)) + ([0] * (pad_length - len(seq)))
-                        for seq in token_ids]
-        token_ids = [seq + ([self.tokenizer.pad_id] * (pad_length - len(seq)))
-                     for seq in token_ids]
-
-        token_ids = torch.tensor(token_ids, dtype=torch.int64).cuda()
-        encoder_mask = torch.tensor(encoder_mask,
-                                    dtype=torch.int64,
-                                    device=token_ids.device)
+    def encode_features(self, smis):
+        """ masked sums + token lengths: the mean depends on the padded
+            length of the batch, EmbeddingDataSplit divides at collate
+        """
+        solu, mask = self._tokenize(smis)
+        solu = self.mmb.encode(solu, mask)
+        solu = solu.to(torch.float32) * mask.unsqueeze(-1)
+        return solu.sum(dim=1), mask.sum(dim=1)
 
-        return token_ids, encoder_mask
+    def _tokenize(self, smis: List[str]):
+        batch = self.as_batch(smis)
+        return (batch.ids.to(self.encoder_device),
+                batch.masks.to(self.encoder_device))
+
+    def masked_forward(self, ids, masks, lengths):
+        """ forward on token ids with masked tokens (<MASK> id, mask 0),
+            see TokenPartitionShap. the mean runs over each molecule's own
+            token count, as for the single-molecule batches of __call__
+        """
+        solu = self.mmb.encode(ids, masks)
+        solu = solu * masks.unsqueeze(-1)
+        solu = solu.sum(dim=1) / lengths.unsqueeze(-1)
+        return self.head(solu.to(torch.float32))
 
     def predict_step(self, batch, batch_idx):
-        inputs, labels = batch
-
-        with torch.set_grad_enabled(True):
-            self.zero_grad()
-            preds = self(inputs)
-        preds.backward(torch.ones_like(preds))
-
-        _, masks = self._tokenize(inputs)
-        tokens = [self.tokenizer.text_to_tokens(s) for s in inputs]
-
-        # salience = self.get_salience()
-        # salience = salience.mean(axis=-1)
-        # salience_colors = [self.cmapper(salience[i], tokens[i]) \
-        #     for i in range(len(inputs))]
-
-        return {"preds": preds, "labels": labels,
-                "smiles": inputs, "tokens": tokens, "masks": masks}
-        # "salience_colors": salience_colors
-        # }
+        # explained with SHAP (explain_shap.py), no attribution here
+        return self.predict_only(batch)
 
     # def mask_forward(self, token, mask):
     #     """ forward without tokenizer"""
@@ -531,22 +717,23 @@ class BaselineAqueousModel(AqueousRegModel):
     #     return self.head(solu)
 
     def __call__(self, inputs):
+        if isinstance(inputs, TokenizedBatch):
+            return self.forward(inputs)
         try:
             if 'MASK' in inputs[0]:
                 # print(inputs)
                 raise TypeError
             else:
                 solu, mask = self._tokenize(inputs)
-                solu.cuda()
-                mask.cuda()
         except:
             inputs = [i.split(' ') for i in inputs]
             token_ids = self.tokenizer.tokens_to_ids(inputs)
 
-            solu = torch.tensor(token_ids, dtype=torch.int64).cuda()
+            solu = torch.tensor(token_ids, dtype=torch.int64,
+                                device=self.encoder_device)
             mask = torch.where(
                 solu == self.tokenizer.mask_id, 0, 1
-            ).cuda()
+            )
 
         solu = self.mmb.encode(solu, mask)
 
@@ -565,7 +752,7 @@ class MMB_R_Featurizer(AqueousRegModel):
                          finetune=finetune)
 
     def featurize(self, inputs):
-        solu, mask = self.tokenizer.tokenize(inputs)
+        solu, mask = self.tokenizer.tokenize(inputs, self.encoder_device)
         solu = self.mmb.encode(solu, mask)
 
         # apply mask
@@ -583,9 +770,9 @@ class MMB_R_Featurizer(AqueousRegModel):
 
 
 class MMB_AVG_Featurizer(BaselineAqueousModel):
-    def __init__(self, head, finetune):
+    def __init__(self, head, finetune, device=None):
         super().__init__(head=head,
-                         finetune=finetune)
+                         finetune=finetune, device=device)
 
     def featurize(self, inputs):
         solu, mask = self._tokenize(inputs)
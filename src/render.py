@@ -0,0 +1,146 @@
+import os
+import time
+import shutil
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from rdkit import Chem
+from rdkit.Chem import Draw
+from src.cache import hash_bytes
+
+
+def render_molecule(smiles, atom_colors, path, size=700, partial=False):
+    ''' draw smiles with highlighted atoms {atom_idx: [rgba]} to a png.
+        falls back to the plain molecule if the colours do not match the
+        atom count (partial=True allows fewer colours than atoms)
+    '''
+    mol = Chem.MolFromSmiles(smiles)
+    mol = Draw.PrepareMolForDrawing(mol)
+    d = Draw.rdMolDraw2D.MolDraw2DCairo(size, size)
+    d.drawOptions().padding = 0.0
+
+    mismatch = int(mol.GetNumAtoms()) - len(atom_colors.keys())
+    if mismatch < 0 or (mismatch > 0 and not partial):
+        d.DrawMolecule(mol)
+    else:
+        d.DrawMoleculeWithHighlights(mol, '', atom_colors, {}, {}, {}, -1)
+    d.FinishDrawing()
+
+    with open(file=path, mode='wb') as f:
+        f.write(d.GetDrawingText())
+    return path
+
+
+class MoleculeRenderer():
+    ''' queue of (smiles, atom colours, path) render jobs, drawn by a pool
+        of worker processes on run(). a worker crashing inside RDKit
+        (segfault) only fails its own job: a broken pool is restarted on
+        halves of the remaining jobs until the crashing one is isolated.
+        n_workers=0 renders in the calling process.
+        with a cache_dir, pngs are stored by a hash of smiles + atom colours
+        and copied to their path, so unchanged attributions are not redrawn.
+    '''
+
+    def __init__(self, n_workers=4, size=700, partial=False, context='fork',
+                 cache_dir=None):
+        self.n_workers = n_workers
+        self.size = size
+        self.partial = partial
+        self.context = context
+        self.cache_dir = cache_dir
+        self.jobs = []
+        self.copies = []
+        self.failed = []
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def cache_path(self, smiles, atom_colors):
+        colors = repr(sorted((i, [tuple(map(float, c)) for c in v])
+                             for i, v in atom_colors.items()))
+        key = hash_bytes(smiles, colors, f"{self.size}-{self.partial}")
+        return f"{self.cache_dir}/{key}.png"
+
+    def submit(self, smiles, atom_colors, path):
+        if not self.cache_dir:
+            self.jobs.append((smiles, dict(atom_colors), path))
+            return
+        cached = self.cache_path(smiles, atom_colors)
+        if os.path.exists(cached):
+            self.hits += 1
+        else:
+            self.jobs.append((smiles, dict(atom_colors), cached))
+        self.copies.append((cached, path))
+
+    def render_serial(self, jobs):
+        for smi, colors, path in jobs:
+            try:
+                render_molecule(smi, colors, path, self.size, self.partial)
+            except Exception as e:
+                print(f"render failed for {path}: {e}")
+                self.failed.append(path)
+
+    def render_pool(self, jobs):
+        ''' returns the jobs that were lost to a broken pool '''
+        lost = []
+        ctx = mp.get_context(self.context)
+        with ProcessPoolExecutor(self.n_workers, mp_context=ctx) as pool:
+            futures = {pool.submit(render_molecule, smi, colors, path,
+                                   self.size, self.partial): i
+                       for i, (smi, colors, path) in enumerate(jobs)}
+            for future in as_completed(futures):
+                job = jobs[futures[future]]
+                try:
+                    future.result()
+                except BrokenProcessPool:
+                    lost.append(job)
+                except Exception as e:
+                    print(f"render failed for {job[2]}: {e}")
+                    self.failed.append(job[2])
+        return lost
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+        jobs = list({job[2]: job for job in jobs}.values())
+        failed = self.render(jobs)
+        copies, self.copies = self.copies, []
+        for path in dict.fromkeys(os.path.dirname(c[1]) for c in copies):
+            os.makedirs(path or '.', exist_ok=True)
+        for cached, path in copies:
+            if cached not in failed:
+                shutil.copyfile(cached, path)
+        if self.cache_dir:
+            print(f"render cache {self.cache_dir}: {self.hits} hits, "
+                  f"{len(jobs)} drawn")
+        return failed
+
+    def render(self, jobs):
+        if not jobs:
+            return []
+        for path in dict.fromkeys(os.path.dirname(j[2]) for j in jobs):
+            os.makedirs(path or '.', exist_ok=True)
+        start = time.time()
+        n_failed = len(self.failed)
+        if self.n_workers == 0:
+            self.render_serial(jobs)
+        else:
+            todo = [jobs]
+            while todo:
+                chunk = todo.pop()
+                lost = self.render_pool(chunk)
+                if not lost:
+                    continue
+                if len(chunk) == 1:
+                    print(f"render worker crashed on {chunk[0][2]}")
+                    self.failed.append(chunk[0][2])
+                    continue
+                # bisect until the crashing job is alone in its pool
+                half = (len(lost) + 1) // 2
+                todo.extend([lost[half:], lost[:half]] if len(lost) > 1
+                            else [lost])
+        elapsed = max(time.time() - start, 1e-9)
+        n_done = len(jobs) - (len(self.failed) - n_failed)
+        print(f"rendered {n_done}/{len(jobs)} molecules in {elapsed:.1f}s "
+              f"({n_done / elapsed:.1f} mol/s, {self.n_workers} workers)")
+        return self.failed[n_failed:]
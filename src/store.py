@@ -0,0 +1,167 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class RaggedArray():
+    ''' variable-length rows as one flat values array + offsets [n+1],
+        rows are views into values (zero-copy on memory-mapped stores) '''
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_rows(cls, rows, dtype=None):
+        rows = [np.asarray(r, dtype=dtype) for r in rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(r) for r in rows])
+        values = np.concatenate(rows) if rows else np.zeros(0, dtype=dtype)
+        return cls(values.astype(dtype) if dtype else values, offsets)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def tolist(self):
+        return [self[i].tolist() for i in range(len(self))]
+
+
+def ragged_cosine_similarity(columns, n=None):
+    ''' pairwise cosine similarity of M ragged columns per row (molecule).
+        columns: list of M RaggedArray, rows compared up to n (shortest)
+        returns: sims [n, M, M] (nan where rows mismatch), valid [n] bool.
+        a row is valid if it is non-empty and of equal length in all columns;
+        zero vectors have similarity 0, as sklearn's cosine_similarity.
+    '''
+    n = min(len(c) for c in columns) if n is None else n
+    lengths = np.stack([c.lengths[:n] for c in columns])      # [M, n]
+    valid = np.all(lengths == lengths[0], axis=0) & (lengths[0] > 0)
+    sims = np.full((n, len(columns), len(columns)), np.nan)
+    if not valid.any():
+        return sims, valid
+
+    # flat buffer of the valid rows, identical layout for every column
+    rows = np.flatnonzero(valid)
+    seg = lengths[0, rows]
+    starts = np.zeros(len(rows), dtype=np.int64)
+    starts[1:] = np.cumsum(seg)[:-1]
+    pos = np.arange(seg.sum()) - np.repeat(starts, seg)
+    values = np.stack([
+        np.asarray(c.values, dtype=np.float64)[
+            np.repeat(np.asarray(c.offsets[:-1])[rows], seg) + pos]
+        for c in columns])                                      # [M, L]
+
+    # segment-wise dot products of all column pairs: [M, M, n_valid],
+    # one column against all others at a time keeps memory at [M, L]
+    dots = np.stack([np.add.reduceat(v[None, :] * values, starts, axis=-1)
+                     for v in values])
+    norms = np.sqrt(np.einsum('iir->ir', dots))
+    norms[norms == 0] = 1.
+    sims[rows] = (dots / (norms[:, None, :] * norms[None, :, :])
+                  ).transpose(2, 0, 1)
+    return sims, valid
+
+
+class AttributionStore():
+    ''' columnar attributions of one model in a directory:
+            meta.json                 row count, column kinds, render settings
+            {col}.npy                 flat columns (uid, preds, smiles, ...)
+            {col}.values/offsets.npy  ragged columns (tokens, *_weights)
+        columns are memory-mapped on load, nothing is parsed.
+    '''
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(f"{path}/meta.json") as f:
+            self.meta = json.load(f)
+        mode = 'r' if mmap else None
+        self.columns = {}
+        for name, kind in self.meta['columns'].items():
+            if kind == 'ragged':
+                self.columns[name] = RaggedArray(
+                    np.load(f"{path}/{name}.values.npy", mmap_mode=mode),
+                    np.load(f"{path}/{name}.offsets.npy", mmap_mode=mode))
+            else:
+                self.columns[name] = np.load(f"{path}/{name}.npy",
+                                             mmap_mode=mode)
+
+    def __len__(self):
+        return self.meta['n']
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def get(self, key, default=None):
+        ''' meta entry, eg. store.get('cmap') '''
+        return self.meta.get(key, default)
+
+    @staticmethod
+    def write(path, columns, **meta):
+        ''' columns: {name: list/array}, rows of lists/arrays become
+            ragged columns, everything else a flat column '''
+        os.makedirs(path, exist_ok=True)
+        kinds = {}
+        n = None
+        for name, col in columns.items():
+            col = list(col) if not isinstance(col, np.ndarray) else col
+            n = len(col) if n is None else n
+            assert len(col) == n, f"column {name}: {len(col)} != {n} rows"
+            if len(col) and isinstance(col[0], (list, tuple, np.ndarray)):
+                first = next((r for r in col if len(r)), [0.])
+                dtype = str if isinstance(first[0], str) else np.float64
+                ragged = RaggedArray.from_rows(col, dtype=dtype)
+                np.save(f"{path}/{name}.values.npy", ragged.values)
+                np.save(f"{path}/{name}.offsets.npy", ragged.offsets)
+                kinds[name] = 'ragged'
+            else:
+                # object columns (str, python floats) as plain dtypes,
+                # loadable without pickle
+                if isinstance(col, list) or col.dtype == object:
+                    col = np.asarray(list(col))
+                np.save(f"{path}/{name}.npy", col)
+                kinds[name] = 'flat'
+        with open(f"{path}/meta.json", 'w') as f:
+            json.dump({'n': n or 0, 'columns': kinds, **meta}, f, indent=1)
+
+    def to_frame(self, columns=None):
+        ''' pandas DataFrame, ragged columns as lists (copies) '''
+        columns = columns or list(self.columns)
+        return pd.DataFrame({
+            name: (self[name].tolist() if isinstance(self[name], RaggedArray)
+                   else np.asarray(self[name]))
+            for name in columns})
+
+
+def save_attributions(outdir, attributions, export_csv=False, **meta):
+    ''' write a DataFrame of attributions as {outdir}/attributions store,
+        colour columns are dropped (derived from weights + meta['cmap']).
+        meta: render settings, eg. viz file pattern, cmap, normalize
+    '''
+    attributions = attributions.drop(columns=[
+        c for c in attributions.columns if c.endswith('colors')])
+    if 'uid' not in attributions.columns:
+        attributions = attributions.reset_index(drop=True)
+        attributions.insert(0, 'uid', range(len(attributions)))
+    AttributionStore.write(f"{outdir}/attributions", {
+        c: attributions[c].values for c in attributions.columns}, **meta)
+    if export_csv:
+        attributions.to_csv(f"{outdir}/attributions.csv", index=False)
+
+
+def load_attributions(outdir, mmap=True):
+    return AttributionStore(f"{outdir}/attributions", mmap=mmap)